@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+GreenLane catalog scoring - runs a product dump through SustainabilityAnalyzer offline
+
+Reads JSONL (one product object per line) or CSV (one product per row) as a stream
+and appends one JSON result per input record to the output file. Progress is
+checkpointed next to the output, so an interrupted run picks up where it stopped, and
+records already in the output are skipped. Identical products are analyzed once and
+their result is copied to every record.
+
+    python local-llm/score_catalog.py catalog.jsonl --output scores.jsonl --workers 8
+    python local-llm/score_catalog.py catalog.csv --output scores.jsonl --processes 2 --mode likelihood
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+# CSV column names accepted for the analyzer's product fields
+COLUMN_ALIASES = {
+    "title": "productTitle",
+    "name": "productTitle",
+    "product_title": "productTitle",
+    "material": "materials",
+    "details": "description",
+}
+
+# Seconds between checkpoint writes (progress lines use --report-every)
+CHECKPOINT_INTERVAL = 5.0
+
+
+def read_products(path, fmt, start=0):
+    """Yield (record number, product dict or None) from a JSONL or CSV file, from record start on"""
+    stream = sys.stdin if str(path) == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(stream)):
+                if number < start:
+                    continue
+                yield number, {COLUMN_ALIASES.get(k, k): v for k, v in row.items() if k and v}
+        else:
+            for number, line in enumerate(stream):
+                # Resumed runs skip finished records without parsing them
+                if number < start or not line.strip():
+                    continue
+                try:
+                    product = json.loads(line)
+                except json.JSONDecodeError:
+                    product = None
+                yield number, product if isinstance(product, dict) else None
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def load_done_records(output_path):
+    """Record numbers already scored in the output; drops a partial line left by a crash"""
+    records = set()
+    if not output_path.exists():
+        return records
+    with open(output_path, "rb+") as f:
+        data_end = 0
+        for line in iter(f.readline, b""):
+            if not line.endswith(b"\n"):
+                break
+            data_end += len(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # Failed records are scored again
+            if isinstance(record.get("record"), int) and "error" not in record:
+                records.add(record["record"])
+        f.truncate(data_end)
+    return records
+
+
+def read_checkpoint(checkpoint_path, input_path):
+    """Record number to resume from (0 when there is no checkpoint for this input)"""
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return 0
+    if checkpoint.get("input") != str(input_path):
+        print(f"[WARN] Checkpoint {checkpoint_path} is for {checkpoint.get('input')}, starting over")
+        return 0
+    return int(checkpoint.get("nextRecord", 0))
+
+
+def write_checkpoint(checkpoint_path, input_path, next_record, stats):
+    """Atomically record that every record before next_record is in the output"""
+    tmp = checkpoint_path.with_name(checkpoint_path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"input": str(input_path), "nextRecord": next_record, "stats": stats,
+                   "updatedAt": time.time()}, f)
+    os.replace(tmp, checkpoint_path)
+
+
+def score_catalog(analyzer, input_path, output_path, fmt="jsonl", workers=4, mode=None, report_every=10.0):
+    """Score every product of the catalog into output_path, returns the run's counters"""
+    from server_docker import DEBUG_FIELDS, QueueFullError, ResultCache
+
+    output_path = Path(output_path)
+    checkpoint_path = output_path.with_name(output_path.name + ".checkpoint")
+    start_record = read_checkpoint(checkpoint_path, input_path) if str(input_path) != "-" else 0
+    done_records = load_done_records(output_path) if str(input_path) != "-" else set()
+    if start_record or done_records:
+        print(f"[CATALOG] Resuming at record {start_record}, {len(done_records)} records already scored")
+
+    stats = {"scored": 0, "llm": 0, "duplicates": 0, "skipped": 0, "invalid": 0, "failed": 0}
+
+    def analyze(product):
+        # A full queue just means the model is busy, wait and resubmit
+        while True:
+            try:
+                return analyzer.analyze(product)
+            except QueueFullError as e:
+                time.sleep(min(e.retry_after, 1))
+
+    in_flight = {}  # future -> [(record number, product)], every record with the future's key
+    running = {}  # key -> future analyzing it
+    unfinished = set()  # record numbers submitted but not written yet
+    next_record = start_record
+    started = time.time()
+    last_report = last_checkpoint = started
+
+    def watermark():
+        return min(unfinished) if unfinished else next_record
+
+    def report(final=False):
+        elapsed = time.time() - started
+        rate = stats["scored"] / elapsed if elapsed > 0 else 0
+        llm_share = stats["llm"] / stats["scored"] if stats["scored"] else 0
+        print(f"[CATALOG] {'Done: ' if final else ''}{stats['scored']} scored ({llm_share:.0%} LLM), "
+              f"{stats['duplicates']} duplicates, {stats['skipped']} skipped, {stats['invalid']} invalid, {stats['failed']} failed, "
+              f"{rate:.1f} products/s, {elapsed:.0f}s")
+
+    def collect(futures, out):
+        for future in futures:
+            records = in_flight.pop(future)
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, str(e)
+            for number, product in records:
+                key = ResultCache.make_key(product)
+                running.pop(key, None)
+                record = {"record": number, "key": key, "productTitle": product.get("productTitle")}
+                if "id" in product:
+                    record["id"] = product["id"]
+                if error is not None:
+                    # The checkpoint stays before a failed record, so a resumed run scores it again
+                    record["error"] = error
+                    stats["failed"] += 1
+                    out.write(json.dumps(record) + "\n")
+                    continue
+                record.update({k: v for k, v in result.items() if k not in DEBUG_FIELDS})
+                stats["scored"] += 1
+                stats["llm"] += bool(result.get("usedLLM"))
+                out.write(json.dumps(record) + "\n")
+                unfinished.discard(number)
+
+    def checkpoint(out, force=False):
+        nonlocal last_report, last_checkpoint
+        now = time.time()
+        if force or now - last_checkpoint >= CHECKPOINT_INTERVAL:
+            # Results reach the disk before the checkpoint that covers them
+            out.flush()
+            os.fsync(out.fileno())
+            if str(input_path) != "-":
+                write_checkpoint(checkpoint_path, input_path, watermark(), stats)
+            last_checkpoint = now
+        if report_every and now - last_report >= report_every:
+            report()
+            last_report = now
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for number, product in read_products(input_path, fmt, start_record):
+                next_record = number + 1
+                if product is None or not product.get("productTitle"):
+                    stats["invalid"] += 1
+                    continue
+                if mode and "mode" not in product:
+                    product["mode"] = mode
+                if number in done_records:
+                    stats["skipped"] += 1
+                    continue
+
+                # The same product already being analyzed: its result is copied to this record
+                key = ResultCache.make_key(product)
+                if key in running:
+                    stats["duplicates"] += 1
+                    unfinished.add(number)
+                    in_flight[running[key]].append((number, product))
+                    continue
+
+                # Bounded window: the catalog is never held in memory
+                while len(in_flight) >= workers * 2:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished, out)
+                    checkpoint(out)
+                unfinished.add(number)
+                future = executor.submit(analyze, product)
+                in_flight[future] = [(number, product)]
+                running[key] = future
+                checkpoint(out)
+
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished, out)
+                checkpoint(out)
+        except KeyboardInterrupt:
+            print("[CATALOG] Interrupted, saving checkpoint (rerun the same command to resume)")
+            for future in in_flight:
+                future.cancel()
+            raise
+        finally:
+            checkpoint(out, force=True)
+
+    report(final=True)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a product catalog offline with the local LLM")
+    parser.add_argument("input", help="catalog file (.jsonl or .csv), - for JSONL on stdin")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--format", choices=("auto", "jsonl", "csv"), default="auto",
+                        help="input format (auto: from the file extension)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="products analyzed concurrently (the inference queue micro-batches them)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="inference worker processes, each with its own model (sets INFERENCE_WORKERS)")
+    parser.add_argument("--mode", choices=("auto", "generate", "likelihood", "keyword"), default=None,
+                        help="analysis mode for products that don't set one")
+    parser.add_argument("--report-every", type=float, default=10.0,
+                        help="seconds between progress lines (0 = only the final summary)")
+    parser.add_argument("--stub", action="store_true",
+                        help="use the stub program instead of the model (pipeline testing)")
+    args = parser.parse_args()
+
+    # The server module reads its configuration at import time
+    if args.processes is not None:
+        os.environ["INFERENCE_WORKERS"] = str(args.processes)
+    import server_docker
+
+    fmt = args.format
+    if fmt == "auto":
+        fmt = "csv" if str(args.input).lower().endswith(".csv") else "jsonl"
+
+    if args.stub:
+        analyzer = server_docker.stub_analyzer()
+    else:
+        analyzer = server_docker.SustainabilityAnalyzer()
+        analyzer.warm_up()
+        if not analyzer.can_infer and args.mode != "keyword":
+            print("[WARN] Model not available, products get keyword scores")
+    # Bounded in-memory cache: repeated products later in the catalog reuse recent results
+    analyzer.result_cache = server_docker.ResultCache(path="")
+
+    try:
+        score_catalog(analyzer, args.input, args.output, fmt, max(1, args.workers), args.mode, args.report_every)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,33 @@ Docker Edition with FULL Llama Inference
 SFHacks 2026 - Meta ExecuTorch Sponsor Track
 """
 
+import argparse
+import atexit
+import bisect
+import codecs
+import ctypes
+import hashlib
+import hmac
 import json
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import sqlite3
 import sys
+import threading
 import time
 import re
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import select
+import socket
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 
 # Configuration - Docker or local
 PORT = int(os.environ.get("PORT", 8765))
@@ -20,14 +40,124 @@ IS_DOCKER = os.environ.get("DOCKER_ENV", "false") == "true"
 
 DOCKER_MODEL_DIR = Path("/models")
 LOCAL_MODEL_DIR = Path(__file__).parent / "models" / "Llama-3.2-1B-ET"
-MODEL_DIR = DOCKER_MODEL_DIR if DOCKER_MODEL_DIR.exists() and (DOCKER_MODEL_DIR / "llama3_2-1B.pte").exists() else LOCAL_MODEL_DIR
+MODEL_DIR = DOCKER_MODEL_DIR if DOCKER_MODEL_DIR.exists() and any(DOCKER_MODEL_DIR.glob("*.pte")) else LOCAL_MODEL_DIR
 
 MODEL_PATH = MODEL_DIR / "llama3_2-1B.pte"
 TOKENIZER_PATH = MODEL_DIR / "tokenizer.model"
 
+# KV cache handling between requests: "overwrite" keeps one resident program and
+# rewrites cache slots by position, "reload" restores the old reload-per-request path
+KV_RESET_MODE = os.environ.get("KV_RESET_MODE", "overwrite")
+
+# Prefill: "auto" probes the export for dynamic sequence length at startup,
+# PREFILL_CHUNK > 0 splits batched prefill into fixed-size chunks (0 = whole prompt)
+PREFILL_MODE = os.environ.get("PREFILL_MODE", "auto")
+PREFILL_CHUNK = int(os.environ.get("PREFILL_CHUNK", 0))
+
+# Reuse KV slots already holding the prompt's leading tokens (the shared template prefix)
+PREFIX_CACHE = os.environ.get("PREFIX_CACHE", "true") == "true"
+
+# /analyze result cache: max entries, TTL in seconds, optional SQLite file for persistence
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 2048))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 6 * 3600))
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "")
+
+# Requests allowed to wait for the inference worker before /analyze answers 503,
+# and the most products one /analyze/batch call may carry
+QUEUE_MAX = int(os.environ.get("QUEUE_MAX", 16))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 200))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 5))
+
+# Micro-batching: resident model instances stepped in lockstep, and how long the
+# worker waits for concurrent requests to join a batch
+MODEL_POOL_SIZE = int(os.environ.get("MODEL_POOL_SIZE", 1))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 10))
+
+# Process-pool inference: worker processes with their own ExecuTorch program (0 keeps
+# inference in-process), threads per worker (0 splits the CPUs evenly), and how long a
+# single generation may run before its worker is considered hung and restarted
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 0))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 0))
+WORKER_TIMEOUT = float(os.environ.get("WORKER_TIMEOUT", 120))
+
+# Model startup: "mmap" pages weights in on first use, "prefault" reads them in at load,
+# "mlock" also pins them in RAM; "background" warm-up serves /health (and keyword
+# results) while the model loads, "blocking" loads before the server starts listening
+MODEL_LOAD_MODE = os.environ.get("MODEL_LOAD_MODE", "mmap")
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "background")
+
+# Metrics: histogram buckets in seconds, and the ring buffer size behind windowed stats
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", 1024))
+
+# Memoized prompt encoding: encoded segments kept (template pieces, titles, materials)
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", 4096))
+
+# Early-stop decoding: "|"-separated stop strings, sentences kept after the score
+# (-1 disables), max complete sentences (0 disables), decode budget in ms (0 disables)
+STOP_STRINGS = [s.replace("\\n", "\n") for s in os.environ.get("STOP_STRINGS", "").split("|") if s]
+STOP_SENTENCES_AFTER_SCORE = int(os.environ.get("STOP_SENTENCES_AFTER_SCORE", 2))
+STOP_MAX_SENTENCES = int(os.environ.get("STOP_MAX_SENTENCES", 6))
+STOP_BUDGET_MS = float(os.environ.get("STOP_BUDGET_MS", 0))
+
+# Context budget: tokens kept free for generation (the prompt gets the rest of the
+# model's max_seq_len), and the fallback when the export has no get_max_seq_len
+GENERATION_RESERVE = int(os.environ.get("GENERATION_RESERVE", 38))
+DEFAULT_MAX_SEQ_LEN = int(os.environ.get("DEFAULT_MAX_SEQ_LEN", 128))
+
+# Speculative decoding: "ngram" drafts tokens from earlier outputs and the prompt and
+# verifies them in one multi-token forward (needs an export that returns logits for
+# every position); draft tokens per step, and the n-gram length drafts are keyed on
+SPECULATIVE = os.environ.get("SPECULATIVE", "off")
+SPECULATIVE_TOKENS = int(os.environ.get("SPECULATIVE_TOKENS", 4))
+SPECULATIVE_NGRAM = int(os.environ.get("SPECULATIVE_NGRAM", 3))
+
+# How mode "auto" requests use the model: "generate" decodes a text completion,
+# "likelihood" only prefills and reads the score from the next-token distribution
+SCORING_MODE = os.environ.get("SCORING_MODE", "generate")
+# Probability the score tokens 0..10 need together for a likelihood score to count;
+# below it the model expects some other continuation and the answer is generated
+LIKELIHOOD_MIN_MASS = float(os.environ.get("LIKELIHOOD_MIN_MASS", 0.2))
+
+# Latency-budget routing: budget applied when a request sends none (0 = always full
+# LLM), tokens a shortened generation needs to reach the score, and how many keyword
+# results may wait for a background LLM upgrade
+LATENCY_BUDGET_MS = float(os.environ.get("LATENCY_BUDGET_MS", 0))
+ROUTER_SHORT_TOKENS = int(os.environ.get("ROUTER_SHORT_TOKENS", 8))
+UPGRADE_MAX_PENDING = int(os.environ.get("UPGRADE_MAX_PENDING", 64))
+
+# Deadlines and cancellation: deadline applied when a request sends none (0 = none;
+# requests can send deadlineMs or X-Deadline-Ms), and how often a running generation
+# checks that its client is still connected
+REQUEST_DEADLINE_MS = float(os.environ.get("REQUEST_DEADLINE_MS", 0))
+CLIENT_CHECK_MS = float(os.environ.get("CLIENT_CHECK_MS", 50))
+
+# HTTP/1.1 keep-alive: seconds an idle connection stays open. Debug fields are only
+# sent with ?debug=1 (responses are compact JSON unless ?pretty is given)
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", 30))
+DEBUG_FIELDS = ("llmRawOutput",)
+
+# Model variants: every .pte in the model directory (quantizations, backends, context
+# lengths). MODEL_VARIANT names one (file name without .pte) or "fastest": with several
+# variants each is benchmarked at startup over VARIANT_BENCH_TOKENS decode steps, and
+# the fastest one whose likelihood score for an eco-friendly probe beats a plastic probe
+# by more than VARIANT_MIN_SCORE_GAP points is served
+MODEL_VARIANT = os.environ.get("MODEL_VARIANT", "fastest")
+VARIANT_BENCH_TOKENS = int(os.environ.get("VARIANT_BENCH_TOKENS", 16))
+VARIANT_MIN_SCORE_GAP = float(os.environ.get("VARIANT_MIN_SCORE_GAP", 0))
+
+# /admin endpoints require this token in X-Admin-Token (unset: loopback clients only)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Per-request tracing: a request sending "X-Trace: 1" is traced, others with probability
+# TRACE_SAMPLE_RATE. The last TRACE_BUFFER traces are served by /debug/traces as Chrome
+# trace-event JSON (chrome://tracing, ui.perfetto.dev)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", 64))
+
 print(f"[CONFIG] Docker: {IS_DOCKER}")
 print(f"[CONFIG] Model dir: {MODEL_DIR}")
-print(f"[CONFIG] Model exists: {MODEL_PATH.exists()}")
+print(f"[CONFIG] Model variants: {sorted(p.stem for p in MODEL_DIR.glob('*.pte')) if MODEL_DIR.exists() else []}")
 
 # Global state
 executorch_available = False
@@ -35,42 +165,159 @@ model = None
 tokenizer = None
 model_load_error = None
 CAN_INFER = False
+PROCESS_START = time.time()
 
-# Try to import ExecuTorch
-try:
-    from executorch.extension.pybindings.portable_lib import _load_for_executorch
-    executorch_available = True
-    print("[OK] ExecuTorch runtime available")
-except ImportError as e:
-    print(f"[WARN] ExecuTorch not available: {e}")
-
-# Load custom Llama operators (required for sdpa + kv_cache)
+runtime_loaded = False
 custom_ops_loaded = False
-if executorch_available:
-    import ctypes
-    pybind_dir = "/opt/conda/envs/py_3.10/lib/python3.10/site-packages/executorch/extension/pybindings"
-    portable_src = os.path.join(pybind_dir, "_portable_lib.cpython-310-aarch64-linux-gnu.so")
-    portable_dst = os.path.join(pybind_dir, "_portable_lib.so")
-    custom_ops_path = "/opt/conda/envs/py_3.10/lib/python3.10/site-packages/executorch/extension/llm/custom_ops/libcustom_ops_aot_lib.so"
-    try:
-        if os.path.exists(portable_src) and not os.path.exists(portable_dst):
-            os.symlink(portable_src, portable_dst)
-        if os.path.exists(custom_ops_path):
-            os.environ["LD_LIBRARY_PATH"] = pybind_dir + ":" + os.environ.get("LD_LIBRARY_PATH", "")
-            ctypes.CDLL(custom_ops_path, mode=ctypes.RTLD_GLOBAL)
-            custom_ops_loaded = True
-            print("[OK] Custom Llama ops loaded (sdpa + kv_cache)")
-    except Exception as e:
-        print(f"[WARN] Custom ops load failed: {e}")
-
-# Try pytorch-tokenizers (comes with executorch 1.1.0) - correct Llama 3.2 tokenizer
 pytorch_tokenizers_available = False
+
+# Optional faster JSON encoder for responses
 try:
-    from pytorch_tokenizers import TiktokenTokenizer
-    pytorch_tokenizers_available = True
-    print("[OK] pytorch-tokenizers (TiktokenTokenizer) available")
+    import orjson
 except ImportError:
-    print("[WARN] pytorch-tokenizers not available")
+    orjson = None
+
+
+def dump_json(data, pretty=False):
+    """Response body bytes: compact unless pretty, encoded by orjson when installed"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(data, option=option)
+    if pretty:
+        return json.dumps(data, indent=2).encode()
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def load_runtime():
+    """Import ExecuTorch, the custom Llama ops and pytorch-tokenizers, returns the import time in ms.
+
+    Deferred until the model is loaded so the HTTP server (and /health) come up first.
+    """
+    global runtime_loaded, executorch_available, custom_ops_loaded, pytorch_tokenizers_available
+    global _load_for_executorch, TiktokenTokenizer
+    if runtime_loaded:
+        return 0
+    runtime_loaded = True
+    start = time.time()
+
+    # Try to import ExecuTorch
+    try:
+        from executorch.extension.pybindings.portable_lib import _load_for_executorch
+        executorch_available = True
+        print("[OK] ExecuTorch runtime available")
+    except ImportError as e:
+        print(f"[WARN] ExecuTorch not available: {e}")
+
+    # Load custom Llama operators (required for sdpa + kv_cache)
+    if executorch_available:
+        pybind_dir = "/opt/conda/envs/py_3.10/lib/python3.10/site-packages/executorch/extension/pybindings"
+        portable_src = os.path.join(pybind_dir, "_portable_lib.cpython-310-aarch64-linux-gnu.so")
+        portable_dst = os.path.join(pybind_dir, "_portable_lib.so")
+        custom_ops_path = "/opt/conda/envs/py_3.10/lib/python3.10/site-packages/executorch/extension/llm/custom_ops/libcustom_ops_aot_lib.so"
+        try:
+            if os.path.exists(portable_src) and not os.path.exists(portable_dst):
+                os.symlink(portable_src, portable_dst)
+            if os.path.exists(custom_ops_path):
+                os.environ["LD_LIBRARY_PATH"] = pybind_dir + ":" + os.environ.get("LD_LIBRARY_PATH", "")
+                ctypes.CDLL(custom_ops_path, mode=ctypes.RTLD_GLOBAL)
+                custom_ops_loaded = True
+                print("[OK] Custom Llama ops loaded (sdpa + kv_cache)")
+        except Exception as e:
+            print(f"[WARN] Custom ops load failed: {e}")
+
+    # Try pytorch-tokenizers (comes with executorch 1.1.0) - correct Llama 3.2 tokenizer
+    try:
+        from pytorch_tokenizers import TiktokenTokenizer
+        pytorch_tokenizers_available = True
+        print("[OK] pytorch-tokenizers (TiktokenTokenizer) available")
+    except ImportError:
+        print("[WARN] pytorch-tokenizers not available")
+
+    return (time.time() - start) * 1000
+
+
+class WeightsMapping:
+    """Read-only view of the .pte whose pages are prefaulted and, in mlock mode, pinned in RAM.
+
+    ExecuTorch's loader mmaps the same file, and a shared read-only mapping maps the
+    very page-cache pages it reads: prefaulting keeps the first forward off the disk
+    and mlock keeps the weights resident under memory pressure, without a private copy.
+    """
+
+    def __init__(self, path, mode=None):
+        self.path = path
+        self.mode = mode or MODEL_LOAD_MODE
+        self.addr = None
+        self.size = 0
+        self.locked = False
+        self.map_ms = 0
+        self.error = None
+        self._libc = None
+
+    def _load_libc(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_long)
+        for name in ("munmap", "mlock", "munlock"):
+            getattr(libc, name).argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+        libc.madvise.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+        return libc
+
+    def _check(self, result, call):
+        if result != 0:
+            errno = ctypes.get_errno()
+            hint = " (check RLIMIT_MEMLOCK)" if call == "mlock" else ""
+            raise OSError(errno, f"{call}: {os.strerror(errno)}{hint}")
+
+    def open(self):
+        """Map and prefault the file (no-op in plain mmap mode), returns the time taken in ms"""
+        if self.mode == "mmap":
+            return 0
+        start = time.time()
+        try:
+            self._libc = libc = self._load_libc()
+            with open(self.path, "rb") as f:
+                self.size = os.fstat(f.fileno()).st_size
+                # MAP_SHARED + PROT_READ: page-cache pages, never copied into anonymous memory
+                flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+                addr = libc.mmap(None, self.size, mmap.PROT_READ, flags, f.fileno(), 0)
+            if addr is None or addr == ctypes.c_void_p(-1).value:
+                self._check(-1, "mmap")
+            self.addr = addr
+            if hasattr(mmap, "MADV_WILLNEED"):
+                libc.madvise(self.addr, self.size, mmap.MADV_WILLNEED)
+            if not hasattr(mmap, "MAP_POPULATE"):
+                for offset in range(0, self.size, mmap.PAGESIZE):
+                    ctypes.string_at(self.addr + offset, 1)
+            if self.mode == "mlock":
+                self._check(libc.mlock(self.addr, self.size), "mlock")
+                self.locked = True
+        except (OSError, ValueError, AttributeError) as e:
+            self.error = str(e)
+            print(f"[WARN] Model {self.mode} failed, using plain mmap: {e}")
+            self.close()
+        self.map_ms = (time.time() - start) * 1000
+        return self.map_ms
+
+    def close(self):
+        """Unpin and unmap the file (the loader's own mapping is unaffected)"""
+        if self.addr is None:
+            return
+        if self.locked:
+            self._libc.munlock(self.addr, self.size)
+            self.locked = False
+        self._libc.munmap(self.addr, self.size)
+        self.addr = None
+
+    def get_stats(self):
+        return {
+            "mode": self.mode,
+            "bytes": self.size,
+            "prefaultMs": round(self.map_ms, 1),
+            "locked": self.locked,
+            "error": self.error
+        }
 
 
 class LlamaTokenizer:
@@ -82,6 +329,11 @@ class LlamaTokenizer:
         self.bos_id = 128000
         self.eos_ids = [128001, 128008, 128009]
         self.backend = None
+        self.segment_cache = OrderedDict()
+        self.segment_lock = threading.Lock()
+        self.segment_hits = 0
+        self.segment_misses = 0
+        self.segments_exact = True
         
         # Try getting vocab info from ExecuTorch model metadata
         if et_model is not None:
@@ -125,37 +377,2230 @@ class LlamaTokenizer:
             return self.tok.decode(ids)
         else:
             return bytes([b for b in ids if b < 256]).decode('utf-8', errors='replace')
+    
+    def _encode_piece(self, text, cache=True):
+        """Encode text without BOS, memoized in an LRU (cache=False only reads it: trial encodings)"""
+        with self.segment_lock:
+            tokens = self.segment_cache.get(text)
+            if tokens is not None and cache:
+                self.segment_cache.move_to_end(text)
+                self.segment_hits += 1
+            elif cache:
+                self.segment_misses += 1
+        if tokens is not None:
+            return tokens
+        if self.tok:
+            tokens = self.tok.encode(text, bos=False, eos=False)
+        else:
+            tokens = list(text.encode('utf-8'))
+        if not cache:
+            return tokens
+        with self.segment_lock:
+            self.segment_cache[text] = tokens
+            while len(self.segment_cache) > TOKENIZER_CACHE_SIZE:
+                self.segment_cache.popitem(last=False)
+        return tokens
+    
+    def encode_segments(self, segments):
+        """Encode a prompt given as text segments, reusing cached encodings of each segment.
+
+        Segments must split at pre-tokenizer boundaries (see ProductPrompt), so the result
+        equals encode() of the joined text.
+        """
+        if not self.segments_exact:
+            return self.encode("".join(segments))
+        tokens = [self.bos_id]
+        for segment in segments:
+            tokens.extend(self._encode_piece(segment))
+        return tokens
+    
+    def verify_segments(self, segments):
+        """Fall back to whole-prompt encoding if segment encoding disagrees with encode()"""
+        self.segments_exact = self.encode_segments(segments) == self.encode("".join(segments))
+        if not self.segments_exact:
+            print("[WARN] Segment encoding differs from full encode, prompt cache disabled")
+        return self.segments_exact
+    
+    def get_stats(self):
+        lookups = self.segment_hits + self.segment_misses
+        return {
+            "backend": self.backend,
+            "segmentCache": self.segments_exact,
+            "cachedSegments": len(self.segment_cache),
+            "hits": self.segment_hits,
+            "misses": self.segment_misses,
+            "hitRate": round(self.segment_hits / lookups, 3) if lookups else 0
+        }
+
+
+class IncrementalDecoder:
+    """Turns generated token ids into text as they arrive, holding back incomplete UTF-8.
+
+    The byte backend feeds raw bytes to codecs' incremental UTF-8 decoder. Other backends
+    decode a short window of recent tokens and only emit once it no longer ends in a
+    replacement character, so each step costs O(window) instead of O(generated).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.skip = set(tokenizer.eos_ids)
+        self.text = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace") if tokenizer.tok is None else None
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def feed(self, token):
+        """Add one token, returns the text it completed (possibly empty)"""
+        if token in self.skip:
+            return ""
+        if self.utf8 is not None:
+            delta = self.utf8.decode(bytes([token])) if token < 256 else ""
+        else:
+            self.tokens.append(token)
+            prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+            new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+            if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+                return ""
+            delta = new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+        self.text += delta
+        return delta
+
+    def flush(self):
+        """Emit whatever is still held back (as replacement characters if incomplete)"""
+        if self.utf8 is not None:
+            delta = self.utf8.decode(b"", final=True)
+        else:
+            prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+            delta = self.tokenizer.decode(self.tokens[self.prefix_offset:])[len(prefix_text):]
+            self.prefix_offset = self.read_offset = len(self.tokens)
+        self.text += delta
+        return delta
+
+
+class ModelSession:
+    """Keeps one ExecuTorch program resident and reuses it across requests"""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.program = None
+        self.load_ms = 0
+        self.loads = 0
+        self.requests = 0
+        self.last_setup_ms = 0
+        self.setup_times = deque(maxlen=100)
+        self.prefill_mode = "per-token"
+        self.last_prefill_ms = 0
+        self.max_seq_len = DEFAULT_MAX_SEQ_LEN
+        self.full_logits = False
+        # Trace of the generation using the session, forwards are recorded when enabled
+        self.trace = NULL_TRACE
+
+        # Decode-step input buffers, allocated on first use and refilled in place
+        self.token_buf = None
+        self.pos_buf = None
+
+        # Token ids whose KV entries are valid at positions 0..len-1
+        self.resident = []
+        self.prefix_tokens = []
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self.reused_tokens = 0
+
+    def load(self):
+        """Load the .pte program (once at startup, or per request in reload mode)"""
+        start = time.time()
+        self.program = _load_for_executorch(str(self.model_path))
+        self.resident = []
+        self.load_ms = (time.time() - start) * 1000
+        self.loads += 1
+        self.max_seq_len = self.read_max_seq_len()
+        return self.program
+
+    def read_max_seq_len(self):
+        """Context length from the export's metadata, DEFAULT_MAX_SEQ_LEN when it has none"""
+        try:
+            if 'get_max_seq_len' in self.program.method_names():
+                result = self.program.run_method("get_max_seq_len", [])
+                if result:
+                    return int(result[0].item() if hasattr(result[0], 'item') else result[0])
+        except Exception as e:
+            print(f"[WARN] Could not read max_seq_len: {e}")
+        return DEFAULT_MAX_SEQ_LEN
+
+    def prompt_budget(self):
+        """Prompt tokens that still leave GENERATION_RESERVE positions for the output"""
+        return max(8, self.max_seq_len - GENERATION_RESERVE)
+
+    def begin(self):
+        """Prepare the resident program for a new request, returns the start position.
+
+        The exported Llama KV cache is indexed by input_pos and attention only looks
+        at positions <= input_pos, so prefilling from position 0 overwrites whatever
+        the previous request left behind - no reload needed to reset it.
+        """
+        start = time.time()
+        if KV_RESET_MODE == "reload" or self.program is None:
+            self.load()
+        self.requests += 1
+        self.last_setup_ms = (time.time() - start) * 1000
+        self.setup_times.append(self.last_setup_ms)
+        return 0
+
+    def forward(self, tokens, pos):
+        """Run one forward call, returns the logits tensor"""
+        traced = self.trace.enabled
+        started = time.time() if traced else 0
+        outputs = self.program.run_method("forward", [tokens, pos])
+        if traced:
+            self.trace.add("forward", started, time.time(), tokens=tokens.shape[1], pos=int(pos.item()))
+        if isinstance(outputs, (list, tuple)):
+            return outputs[0]
+        return outputs
+
+    def _mark_resident(self, token_ids, pos):
+        """Record that token_ids now occupy the KV slots starting at pos"""
+        if pos == len(self.resident):
+            self.resident.extend(token_ids)
+            return
+        if pos > len(self.resident):
+            # A gap means we lost track of the cache contents
+            self.resident = []
+            return
+        del self.resident[pos:]
+        self.resident.extend(token_ids)
+
+    def _run(self, token_ids, pos):
+        """Forward token_ids starting at pos, keeping the resident-token record in sync"""
+        import torch
+
+        # Token must be 2D [1, n], position must be 1D [1] (start of the chunk)
+        token_tensor = torch.tensor([token_ids], dtype=torch.long)
+        pos_tensor = torch.tensor([pos], dtype=torch.long)
+        try:
+            logits = self.forward(token_tensor, pos_tensor)
+        except Exception:
+            self.resident = []
+            raise
+        self._mark_resident(token_ids, pos)
+        return logits
+
+    def step(self, token, pos):
+        """Feed one generated token at pos, returns the next-token logits"""
+        if self.token_buf is None:
+            import torch
+            self.token_buf = torch.zeros((1, 1), dtype=torch.long)
+            self.pos_buf = torch.zeros((1,), dtype=torch.long)
+        self.token_buf.fill_(token)
+        self.pos_buf.fill_(pos)
+        try:
+            logits = self.forward(self.token_buf, self.pos_buf)
+        except Exception:
+            self.resident = []
+            raise
+        self._mark_resident([token], pos)
+        return logits
+
+    def verify(self, token_ids, pos):
+        """Forward several tokens at once, returns one logits row per token ([n, vocab])"""
+        return self._run(token_ids, pos)[0]
+
+    def rewind(self, pos):
+        """Forget KV entries from pos on (rejected draft tokens), later forwards overwrite them"""
+        del self.resident[pos:]
+
+    def detect_prefill_mode(self):
+        """Check whether forward() accepts a [1, N] token chunk (dynamic seq len export)"""
+        if PREFILL_MODE != "auto":
+            self.prefill_mode = PREFILL_MODE
+            return self.prefill_mode
+
+        # Probe with a 2-token chunk at position 0, later prefills overwrite these slots
+        try:
+            logits = self._run([0, 0], 0)
+            self.prefill_mode = "batched" if logits is not None and logits.numel() > 0 else "per-token"
+            # Logits for every position make the export usable for draft verification
+            self.full_logits = logits is not None and logits.dim() == 3 and logits.shape[1] == 2
+        except Exception as e:
+            print(f"[INFO] Batched prefill unsupported by export ({str(e)[:80]})")
+            self.prefill_mode = "per-token"
+        return self.prefill_mode
+
+    def warm_prefix(self, prefix_tokens):
+        """Prefill the shared prompt-template prefix once so every request starts past it"""
+        self.prefix_tokens = list(prefix_tokens)
+        if PREFIX_CACHE and self.prefix_tokens:
+            self.prefill(self.prefix_tokens, count=False)
+            print(f"[OK] Prefix cache warmed ({len(self.prefix_tokens)} tokens)")
+
+    def _reusable_len(self, tokens):
+        """Number of leading prompt tokens already resident in the KV cache"""
+        n = 0
+        limit = min(len(tokens), len(self.resident))
+        while n < limit and tokens[n] == self.resident[n]:
+            n += 1
+        # Always recompute the last prompt token so its logits are available
+        return min(n, len(tokens) - 1)
+
+    def prefill(self, tokens, count=True):
+        """Run the prompt through the model, returns logits for the last prompt token"""
+        start = time.time()
+
+        start_pos = self._reusable_len(tokens) if PREFIX_CACHE else 0
+        if count and PREFIX_CACHE:
+            if start_pos >= max(1, len(self.prefix_tokens)):
+                self.prefix_hits += 1
+            else:
+                self.prefix_misses += 1
+            self.reused_tokens += start_pos
+
+        if self.prefill_mode == "batched":
+            chunk = PREFILL_CHUNK if PREFILL_CHUNK > 0 else len(tokens)
+        else:
+            chunk = 1
+
+        logits = None
+        for i in range(start_pos, len(tokens), chunk):
+            logits = self._run(tokens[i:i + chunk], i)
+
+        # Exports with full logits return [1, n, vocab], keep the last position only
+        if logits is not None and logits.dim() == 3:
+            logits = logits[0, -1]
+        self.last_prefill_ms = (time.time() - start) * 1000
+        return logits
+
+    def get_stats(self):
+        avg_setup = sum(self.setup_times) / len(self.setup_times) if self.setup_times else 0
+        return {
+            "kvResetMode": KV_RESET_MODE,
+            "loadMs": round(self.load_ms, 1),
+            "loads": self.loads,
+            "requests": self.requests,
+            "lastSetupMs": round(self.last_setup_ms, 2),
+            "avgSetupMs": round(avg_setup, 2),
+            "prefillMode": self.prefill_mode,
+            "prefillChunk": PREFILL_CHUNK,
+            "maxSeqLen": self.max_seq_len,
+            "fullLogits": self.full_logits,
+            "promptBudget": self.prompt_budget(),
+            "lastPrefillMs": round(self.last_prefill_ms, 1)
+        }
+
+    def get_prefix_cache_stats(self):
+        lookups = self.prefix_hits + self.prefix_misses
+        return {
+            "enabled": PREFIX_CACHE,
+            "prefixTokens": len(self.prefix_tokens),
+            "hits": self.prefix_hits,
+            "misses": self.prefix_misses,
+            "hitRate": round(self.prefix_hits / lookups, 3) if lookups else 0,
+            "reusedTokens": self.reused_tokens
+        }
+
+
+class ResultCache:
+    """LRU + TTL cache of /analyze results, optionally persisted to SQLite"""
+
+    # Fields that feed the prompt and the keyword scorer
+    KEY_FIELDS = ('productTitle', 'brand', 'materials', 'description')
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, path=RESULT_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path or None
+        self.entries = OrderedDict()  # key -> (stored_at, result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db = None
+
+        if self.path:
+            try:
+                self._open_db()
+            except Exception as e:
+                print(f"[WARN] Result cache persistence disabled: {e}")
+                self.db = None
+
+    @staticmethod
+    def scoring_mode(product_data):
+        """"generate", "likelihood" or "keyword", with auto/llm resolved through SCORING_MODE"""
+        mode = product_data.get('mode', 'auto')
+        if mode == 'keyword':
+            return 'keyword'
+        if mode in ('auto', 'llm'):
+            return SCORING_MODE
+        return 'likelihood' if mode == 'likelihood' else 'generate'
+
+    @classmethod
+    def make_key(cls, product_data):
+        """Hash of the key fields, case-folded with whitespace collapsed, and the scoring mode"""
+        parts = []
+        for field in cls.KEY_FIELDS:
+            value = product_data.get(field) or ''
+            parts.append(' '.join(str(value).split()).casefold())
+        # Generated-text results keep the keys they had before modes existed
+        mode = cls.scoring_mode(product_data)
+        if mode != 'generate':
+            parts.append(mode)
+        return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def _open_db(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, stored_at REAL, result TEXT)"
+        )
+        cutoff = time.time() - self.ttl
+        self.db.execute("DELETE FROM results WHERE stored_at < ?", (cutoff,))
+        rows = self.db.execute(
+            "SELECT key, stored_at, result FROM results ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        # Oldest first so the most recent entries end up at the MRU end
+        for key, stored_at, result in reversed(rows):
+            self.entries[key] = (stored_at, json.loads(result))
+        self.db.commit()
+        print(f"[OK] Result cache loaded {len(self.entries)} entries from {self.path}")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self._delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key, result):
+        with self.lock:
+            stored_at = time.time()
+            self.entries[key] = (stored_at, dict(result))
+            self.entries.move_to_end(key)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO results (key, stored_at, result) VALUES (?, ?, ?)",
+                    (key, stored_at, json.dumps(result))
+                )
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._delete(oldest)
+                self.evictions += 1
+            if self.db is not None:
+                self.db.commit()
+
+    def _delete(self, key):
+        self.entries.pop(key, None)
+        if self.db is not None:
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0,
+            "evictions": self.evictions,
+            "persistPath": self.path if self.db is not None else None
+        }
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue can't take another request"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QueueClosedError(Exception):
+    """Raised by a swapped-out inference backend; the caller resubmits to the current one"""
+
+
+class RequestCancelledError(Exception):
+    """Raised when a generation was dropped: client gone ("cancelled") or deadline passed in the queue ("expired")"""
+
+    def __init__(self, reason):
+        super().__init__(f"Request {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """Deadline and cancellation flag of one request, checked before every forward step.
+
+    probe, if given, returns True once the client has disconnected; it is called at
+    most every CLIENT_CHECK_MS and stays in the process that owns the connection.
+    """
+
+    def __init__(self, deadline_ms=0, probe=None):
+        self.deadline = time.time() + deadline_ms / 1000 if deadline_ms else None
+        self.cancelled = False
+        self.probe = probe
+        self.probed_at = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def reason(self):
+        """"cancelled", "deadline" or None to keep going"""
+        if not self.cancelled and self.probe is not None:
+            now = time.time()
+            if now - self.probed_at >= CLIENT_CHECK_MS / 1000:
+                self.probed_at = now
+                self.cancelled = self.probe()
+        if self.cancelled:
+            return "cancelled"
+        if self.deadline is not None and time.time() >= self.deadline:
+            return "deadline"
+        return None
+
+    def __getstate__(self):
+        # Sent to worker processes without the socket probe
+        state = dict(self.__dict__)
+        state["probe"] = None
+        return state
+
+
+class Trace:
+    """Timed spans of one traced request, kept as Chrome trace events.
+
+    Timestamps are wall-clock microseconds, so spans recorded in an inference worker
+    process line up with the ones recorded here.
+    """
+
+    enabled = True
+
+    def __init__(self, name):
+        self.id = os.urandom(8).hex()
+        self.name = name
+        self.started = time.time()
+        self.ended = None
+        self.events = []
+        self.threads = {}  # tid -> thread name
+        self.args = {}
+
+    @contextmanager
+    def span(self, name, **args):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.time(), **args)
+
+    def add(self, name, started, ended, **args):
+        """Record a span that ran from started to ended (time.time() seconds)"""
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        self.events.append({"name": name, "ph": "X", "tid": thread.ident, "ts": round(started * 1e6, 1),
+                            "dur": round((ended - started) * 1e6, 1), "args": args})
+
+    def merge(self, events, threads):
+        """Take in spans recorded by another process"""
+        self.events.extend(events)
+        self.threads.update(threads)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "startedAt": self.started,
+            "durationMs": round(((self.ended or time.time()) - self.started) * 1000, 2),
+            "spans": len(self.events),
+            **self.args
+        }
+
+
+class NullTrace:
+    """Stands in for a Trace when the request isn't traced: every call is a no-op"""
+
+    enabled = False
+    id = None
+    _span = nullcontext()
+
+    def span(self, name, **args):
+        return self._span
+
+    def add(self, name, started, ended, **args):
+        pass
+
+    def merge(self, events, threads):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class TraceRecorder:
+    """Decides which requests are traced and keeps the most recent finished traces"""
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, size=TRACE_BUFFER):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.traced = 0
+
+    def start(self, name, forced=False):
+        """A new Trace when forced or sampled, NULL_TRACE otherwise"""
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return NULL_TRACE
+        self.traced += 1
+        return Trace(name)
+
+    def finish(self, trace, **args):
+        """Close a trace with a span covering the whole request and keep it"""
+        if not trace.enabled:
+            return
+        trace.ended = time.time()
+        trace.args.update(args)
+        trace.add(trace.name, trace.started, trace.ended, **args)
+        with self.lock:
+            self.traces.append(trace)
+
+    def find(self, trace_id=None):
+        """Buffered traces, oldest first (only the one with trace_id when given)"""
+        with self.lock:
+            traces = list(self.traces)
+        return [t for t in traces if t.id == trace_id] if trace_id else traces
+
+    @staticmethod
+    def chrome_trace(traces):
+        """Trace-event JSON: one process row per request, one thread row per thread it used"""
+        events = []
+        for pid, trace in enumerate(traces, 1):
+            events.append({"name": "process_name", "ph": "M", "pid": pid,
+                           "args": {"name": f"{trace.name} {trace.id}"}})
+            for tid, name in trace.threads.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+            events.extend({**event, "pid": pid} for event in trace.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def get_stats(self):
+        return {
+            "sampleRate": self.sample_rate,
+            "traced": self.traced,
+            "buffered": len(self.traces),
+            "capacity": self.traces.maxlen
+        }
+
+
+TRACER = TraceRecorder()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers (0 when empty)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class Histogram:
+    """Cumulative Prometheus histogram, plus a ring buffer of recent samples for percentiles"""
+
+    def __init__(self, buckets=METRICS_BUCKETS, window=METRICS_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics:
+    """Process-wide stage histograms and outcome counters, rendered for /metrics"""
+
+    STAGE_METRIC = "greenlane_stage_duration_seconds"
+    COUNTER_HELP = {
+        "greenlane_analyses_total": "Analyses answered, by engine (llm or keyword fallback)",
+        "greenlane_prompt_tokens_total": "Prompt tokens fed to the model",
+        "greenlane_generated_tokens_total": "Tokens generated by the model",
+        "greenlane_errors_total": "Errors, by kind",
+        "greenlane_decode_forwards_total": "Forward calls after prefill",
+        "greenlane_draft_proposed_tokens_total": "Speculative draft tokens proposed",
+        "greenlane_draft_accepted_tokens_total": "Speculative draft tokens accepted by the model",
+        "greenlane_router_tier_total": "Analyses by routing tier (llm, llm-short, keyword)",
+        "greenlane_cancelled_total": "Generations cut short: client gone (cancelled), deadline passed in the queue (expired) or while decoding (deadline)"
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()  # name -> {labels: value}
+
+    def observe(self, stage, seconds):
+        """Record one duration for a pipeline stage"""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        key = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        with self.lock:
+            family = self.counters.setdefault(name, OrderedDict())
+            family[key] = family.get(key, 0) + amount
+
+    def value(self, name, **labels):
+        """Current value of a counter (0 if never incremented)"""
+        key = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        with self.lock:
+            return self.counters.get(name, {}).get(key, 0)
+
+    def stage_stats(self):
+        """Windowed percentiles per stage, in ms"""
+        with self.lock:
+            snapshot = {stage: (h.count, list(h.recent)) for stage, h in self.stages.items()}
+        return {
+            stage: {
+                "count": count,
+                "p50Ms": round(percentile(recent, 50) * 1000, 2),
+                "p95Ms": round(percentile(recent, 95) * 1000, 2),
+                "p99Ms": round(percentile(recent, 99) * 1000, 2)
+            } for stage, (count, recent) in snapshot.items()
+        }
+
+    def render(self, extra=()):
+        """Prometheus text exposition; extra is (name, type, help, value) read at scrape time"""
+        lines = [f"# HELP {self.STAGE_METRIC} Time spent in each pipeline stage",
+                 f"# TYPE {self.STAGE_METRIC} histogram"]
+        with self.lock:
+            for stage, histogram in self.stages.items():
+                lines.extend(histogram.render(self.STAGE_METRIC, f'stage="{stage}"'))
+            # Each family's samples stay together under its HELP/TYPE header
+            counters = [(name, list(family.items())) for name, family in self.counters.items()]
+        for name, samples in counters:
+            lines.append(f"# HELP {name} {self.COUNTER_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in samples:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        for name, kind, help_text, value in extra:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+# "N out of M" / "N/M" score in model output
+SCORE_PATTERN = re.compile(r'(\d+)\s*(?:out of|/)\s*(\d+)')
+
+
+def count_sentences(text):
+    """Complete sentences in text, split the same way as _parse_llm_response"""
+    pieces = re.split(r'[.!?\n]', text)
+    # The last piece has no terminator yet
+    return sum(1 for piece in pieces[:-1] if len(piece.strip()) > 10)
+
+
+class StopCriteria:
+    """Decides when generated text already holds everything _parse_llm_response uses"""
+
+    def __init__(self, stop_strings=None, sentences_after_score=STOP_SENTENCES_AFTER_SCORE,
+                 max_sentences=STOP_MAX_SENTENCES, budget_ms=STOP_BUDGET_MS):
+        self.stop_strings = STOP_STRINGS if stop_strings is None else stop_strings
+        self.sentences_after_score = sentences_after_score
+        self.max_sentences = max_sentences
+        self.budget_ms = budget_ms
+
+    def check(self, text, elapsed_ms):
+        """Returns the stop reason, or None to keep decoding"""
+        if any(stop in text for stop in self.stop_strings):
+            return "stop_string"
+        if self.budget_ms and elapsed_ms >= self.budget_ms:
+            return "time_budget"
+        if self.sentences_after_score >= 0:
+            match = SCORE_PATTERN.search(text.lower())
+            # Require text after the match so "7 out of 1" can still become "7 out of 10"
+            if match and match.end() < len(text) and count_sentences(text[match.end():]) >= self.sentences_after_score:
+                return "score"
+        if self.max_sentences and count_sentences(text) >= self.max_sentences:
+            return "max_sentences"
+        return None
+
+    def trim(self, text):
+        """Cut text at the first stop string"""
+        for stop in self.stop_strings:
+            if stop in text:
+                text = text[:text.index(stop)]
+        return text
+
+
+class GreedySampler:
+    """Greedy next-token pick with EOS suppressed by one precomputed index_fill_"""
+
+    def __init__(self, eos_ids):
+        self.eos_ids = list(eos_ids)
+        self.vocab_size = None
+        self.eos_index = None
+
+    def select(self, logits):
+        """Argmax over logits (any shape ending in vocab), EOS masked in place"""
+        import torch
+
+        logits_flat = logits.view(-1)
+        # .float() would copy, only convert when the export returns half precision
+        if logits_flat.dtype != torch.float32:
+            logits_flat = logits_flat.float()
+        if self.vocab_size != logits_flat.shape[0]:
+            self.vocab_size = logits_flat.shape[0]
+            self.eos_index = torch.tensor([i for i in self.eos_ids if i < self.vocab_size], dtype=torch.long)
+        # Suppress EOS so the base model keeps going
+        if self.eos_index.numel():
+            logits_flat.index_fill_(0, self.eos_index, float('-inf'))
+        return int(torch.argmax(logits_flat).item())
+
+
+class StubProgram:
+    """Deterministic stand-in for the .pte program, for benchmarks on machines without the model.
+
+    After any prompt it "generates" the script tokens in order, with logits that put
+    nearly all the probability on the next script token (likelihood scoring reads it).
+    Predictions depend only on the tokens in the KV slots up to each position, so rewinds
+    after rejected draft tokens behave like the real model. With full_logits it returns
+    [1, n, vocab] like exports that keep every position's logits.
+    """
+
+    def __init__(self, vocab_size, script_tokens, full_logits=False):
+        import torch
+
+        self.vocab_size = vocab_size
+        self.script = list(script_tokens)
+        self.full_logits = full_logits
+        self.zeros = torch.zeros((1, vocab_size), dtype=torch.float32)
+        # runs[p]: how many script tokens in a row end at position p
+        self.runs = []
+        self.busy = 0.0  # seconds spent inside run_method
+
+    def method_names(self):
+        return ['forward']
+
+    def run_method(self, name, inputs):
+        import torch
+
+        start = time.perf_counter()
+        tokens, pos = inputs
+        token_ids = [int(t) for t in tokens.view(-1).tolist()]
+        start_pos = int(pos.view(-1)[0].item())
+        del self.runs[start_pos:]
+        predictions = []
+        for token in token_ids:
+            run = self.runs[-1] if self.runs else 0
+            run = run + 1 if token == self.script[run % len(self.script)] else 0
+            self.runs.append(run)
+            predictions.append(self.script[run % len(self.script)])
+        if not self.full_logits:
+            predictions = predictions[-1:]
+        logits = torch.zeros((len(predictions), self.vocab_size), dtype=torch.float32)
+        for row, expected in enumerate(predictions):
+            logits[row, expected] = 20.0
+        logits = logits.view(1, len(predictions), self.vocab_size) if self.full_logits else logits
+        self.busy += time.perf_counter() - start
+        return [logits]
+
+
+class NgramDraft:
+    """Draft tokens for speculative decoding, no second model needed.
+
+    Continuations of the last n tokens seen in earlier outputs (the analyses repeat a lot
+    of boilerplate), falling back to prompt lookup: the tokens that followed the most
+    recent earlier occurrence of the current suffix in the prompt and output so far.
+    """
+
+    def __init__(self, n=SPECULATIVE_NGRAM, max_entries=50000):
+        self.n = n
+        self.max_entries = max_entries
+        self.table = OrderedDict()
+        self.lock = threading.Lock()
+
+    def learn(self, tokens):
+        """Remember the continuations in a finished output"""
+        with self.lock:
+            for i in range(len(tokens) - self.n):
+                key = tuple(tokens[i:i + self.n])
+                self.table[key] = tuple(tokens[i + self.n:i + self.n + SPECULATIVE_TOKENS])
+                self.table.move_to_end(key)
+            while len(self.table) > self.max_entries:
+                self.table.popitem(last=False)
+
+    def propose(self, context, k):
+        """Up to k tokens likely to follow context"""
+        with self.lock:
+            draft = self.table.get(tuple(context[-self.n:]))
+        if draft:
+            return list(draft[:k])
+        for n in range(self.n, 1, -1):
+            suffix = context[-n:]
+            for start in range(len(context) - n - 1, -1, -1):
+                if context[start:start + n] == suffix:
+                    return context[start + n:start + n + k]
+        return []
+
+
+class Generation:
+    """One prompt's decode state, advanced one forward call at a time by the inference worker"""
+
+    def __init__(self, tokenizer, prompt, on_text=None, stop=None, sampler=None, draft=None, cancel=None,
+                 trace=None):
+        self.tokenizer = tokenizer
+        self.sampler = sampler or GreedySampler(tokenizer.eos_ids)
+        self.prompt = prompt
+        self.on_text = on_text
+        self.stop = stop
+        self.stop_reason = None
+        self.text_sent = ""
+        self.session = None
+        self.tokens = []
+        self.generated = []
+        self.next_token = None
+        self.pos = 0
+        self.max_new_tokens = 0
+        self.done = False
+        self.start_time = None
+        self.created_at = time.time()
+        self.first_token_at = None
+        self.tokenize_ms = 0
+        self.prefill_ms = 0
+        self.stats = None
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.draft = draft
+        self.cancel = cancel
+        self.trace = trace or NULL_TRACE
+        self.forwards = 0
+        self.draft_proposed = 0
+        self.draft_accepted = 0
+        self.likelihood = None
+
+    def start(self, session):
+        """Reset the session, prefill the prompt and pick the first generated token"""
+        # Reuse the resident program, KV cache slots are overwritten by position
+        self.session = session
+        session.trace = self.trace
+        setup_started = time.time()
+        loads, reused = session.loads, session.reused_tokens
+        session.begin()
+
+        # Tokenize (encode already prepends BOS) within the prompt budget
+        started = time.time()
+        budget = session.prompt_budget()
+        if isinstance(self.prompt, str):
+            tokens = self.tokenizer.encode(self.prompt)[:budget]
+        else:
+            tokens = self.prompt.encode(self.tokenizer, budget)
+        self.tokenize_ms = (time.time() - started) * 1000
+
+        # Generate until the model's context is full at the latest
+        self.tokens = tokens
+        self.max_new_tokens = session.max_seq_len - len(tokens) - 1
+
+        self.start_time = time.time()
+
+        # Prefill the prompt (one batched call when the export supports it)
+        logits = session.prefill(tokens)
+        self.prefill_ms = (time.time() - self.start_time) * 1000
+        self.pos = len(tokens)
+        if self.trace.enabled:
+            self.trace.add("queue", self.created_at, setup_started)
+            self.trace.add("setup", setup_started, started, reload=session.loads > loads)
+            self.trace.add("tokenize", started, started + self.tokenize_ms / 1000, tokens=len(tokens))
+            self.trace.add("prefill", self.start_time, self.start_time + self.prefill_ms / 1000,
+                           tokens=len(tokens), reused=session.reused_tokens - reused, mode=session.prefill_mode)
+        if getattr(self.prompt, "score_only", False):
+            # Likelihood scoring: the prefill logits are the answer, nothing to decode
+            self.likelihood = self.prompt.read_score(self.tokenizer, logits)
+            self.stop_reason = "likelihood"
+            self.done = True
+        else:
+            self._select(logits)
+        self.first_token_at = time.time()
+
+    def step(self):
+        """Feed the last generated token and pick the next one, or several when a draft verifies"""
+        # Cooperative cancellation: no more forwards once the client left or time ran out
+        reason = self.cancel.reason() if self.cancel is not None else None
+        if reason is not None:
+            self.stop_reason = reason
+            self.done = True
+            return
+        draft = self._propose()
+        self.forwards += 1
+        if not draft:
+            logits = self.session.step(self.next_token, self.pos)
+            self.pos += 1
+            self._select(logits)
+            return
+
+        # Row i holds the logits after draft[:i]; keep picking greedily while the picks
+        # match the draft, so the output is exactly what one-token steps would produce
+        rows = self.session.verify([self.next_token] + draft, self.pos)
+        self.pos += 1
+        self.draft_proposed += len(draft)
+        for i in range(len(draft) + 1):
+            self._select(rows[i])
+            if self.done or i == len(draft) or self.next_token != draft[i]:
+                break
+            self.draft_accepted += 1
+            self.pos += 1
+        self.session.rewind(self.pos)
+
+    def _propose(self):
+        """Draft tokens for this step, none when speculation is off or can't be verified"""
+        if self.draft is None or not self.session.full_logits:
+            return []
+        # Stay inside the token budget and the model context
+        k = min(SPECULATIVE_TOKENS, self.max_new_tokens - len(self.generated) - 1,
+                self.session.max_seq_len - 2 - self.pos)
+        if k <= 0:
+            return []
+        return self.draft.propose(self.tokens + self.generated, k)
+
+    def _select(self, logits):
+        # Greedy next token, EOS suppressed for the base model
+        self.next_token = self.sampler.select(logits)
+        self.generated.append(self.next_token)
+        self.decoder.feed(self.next_token)
+
+        # Each sequence stops on its own: EOS, token budget or model context
+        if self.next_token in self.tokenizer.eos_ids:
+            self.stop_reason = "eos"
+        elif len(self.generated) >= self.max_new_tokens:
+            self.stop_reason = "max_tokens"
+        elif self.pos >= self.session.max_seq_len - 1:
+            self.stop_reason = "context"
+
+        # ...or as soon as the text holds a score and enough sentences
+        if self.stop is not None or self.on_text is not None:
+            text = self.text()
+            if self.stop is not None and self.stop_reason is None:
+                self.stop_reason = self.stop.check(text, (time.time() - self.start_time) * 1000)
+            if self.on_text is not None:
+                self._emit_text(text)
+
+        if self.stop_reason is not None:
+            self.done = True
+
+    def text(self):
+        """Decoded output so far, without EOS tokens and cut at any stop string"""
+        text = self.decoder.text
+        return self.stop.trim(text) if self.stop is not None else text
+
+    def _emit_text(self, text):
+        """Pass newly decoded text to the on_text callback (streaming responses)"""
+        # The decoder holds back partial characters, a stop string may still cut the text
+        if not text.startswith(self.text_sent):
+            return
+        delta = text[len(self.text_sent):]
+        if delta:
+            self.text_sent = text
+            self.on_text(delta)
+
+    def finish(self):
+        """Decode the generated tokens, returns the output text"""
+        elapsed = time.time() - self.start_time
+        if self.session is not None:
+            self.session.trace = NULL_TRACE
+        if self.trace.enabled and self.generated:
+            self.trace.add("decode", self.first_token_at, time.time(), tokens=len(self.generated),
+                           forwards=self.forwards, stopReason=self.stop_reason)
+
+        # Decode generated tokens (EOS removed, cut at stop strings)
+        self.decoder.flush()
+        output_text = self.text()
+        if self.draft is not None:
+            self.draft.learn(self.generated)
+
+        tokens_per_sec = len(self.generated) / elapsed if elapsed > 0 else 0
+        if self.stop_reason == "likelihood":
+            print(f"[LLM] Scored {len(self.tokens)} prompt tokens in {elapsed * 1000:.0f}ms (likelihood: {self.likelihood})")
+        else:
+            print(f"[LLM] Generated {len(self.generated)} tokens in {elapsed:.1f}s ({tokens_per_sec:.1f} tok/s, stop: {self.stop_reason})")
+
+        self.stats = {
+            "stopReason": self.stop_reason,
+            "promptTokens": len(self.tokens),
+            "generatedTokens": len(self.generated),
+            "ttftMs": round((self.first_token_at - self.created_at) * 1000, 2),
+            "tokenizeMs": round(self.tokenize_ms, 2),
+            "prefillMs": round(self.prefill_ms, 2),
+            "decodeMs": round((time.time() - self.first_token_at) * 1000, 2),
+            "forwards": self.forwards,
+            "draftProposed": self.draft_proposed,
+            "draftAccepted": self.draft_accepted,
+            "likelihood": self.likelihood
+        }
+        return output_text
+
+
+class InferenceQueue:
+    """Bounded queue feeding the inference worker, which steps a micro-batch in lockstep.
+
+    Requests arriving within BATCH_WINDOW_MS of each other start together, one per
+    resident ModelSession, and new requests join as soon as a session frees up.
+    """
+
+    def __init__(self, sessions, max_size=QUEUE_MAX):
+        self.sessions = list(sessions)
+        self.parallelism = len(self.sessions)
+        self.free_sessions = list(self.sessions)
+        self.max_size = max_size
+        self.jobs = queue.Queue(maxsize=max_size)
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.batch_sizes = deque(maxlen=100)
+        self.wait_times = deque(maxlen=100)
+        self.service_times = deque(maxlen=100)
+        # Submitted and not finished yet, wherever they are (queue, batch window, running)
+        self.lock = threading.Lock()
+        self.outstanding_jobs = 0
+        self.closed = False
+        # Sessions are stepped from their own threads so forwards can overlap
+        self.executor = ThreadPoolExecutor(max_workers=len(self.sessions)) if len(self.sessions) > 1 else None
+        self.worker = threading.Thread(target=self._worker, name="inference-worker", daemon=True)
+        self.worker.start()
+
+    def submit(self, generation):
+        """Queue a Generation for the inference worker, returns a Future"""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise QueueClosedError()
+            try:
+                self.jobs.put_nowait((time.time(), future, generation))
+            except queue.Full:
+                self.rejected += 1
+                raise QueueFullError(self.retry_after())
+            self.outstanding_jobs += 1
+        return future
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained"""
+        if not self.service_times:
+            return RETRY_AFTER_SECONDS
+        avg_service = sum(self.service_times) / len(self.service_times)
+        backlog = (self.jobs.qsize() + self.in_flight) / len(self.sessions)
+        return max(1, math.ceil(backlog * avg_service))
+
+    def expected_wait_ms(self):
+        """Milliseconds a request submitted now should wait for a session"""
+        waiting = self.jobs.qsize()
+        if waiting < len(self.free_sessions) or not self.service_times:
+            return 0
+        avg_service = sum(self.service_times) / len(self.service_times)
+        return (waiting - len(self.free_sessions) + 1) / len(self.sessions) * avg_service * 1000
+
+    def outstanding(self):
+        """Generations submitted and not finished (queued, in the batch window or running)"""
+        with self.lock:
+            return self.outstanding_jobs
+
+    def _done(self):
+        with self.lock:
+            self.outstanding_jobs -= 1
+
+    def close(self):
+        """Stop taking generations; the worker exits once the ones already queued are done"""
+        with self.lock:
+            self.closed = True
+        # Lands behind every accepted job, submit() refuses new ones from here on
+        self.jobs.put((time.time(), None, None))
+
+    def _collect(self, idle):
+        """Take waiting jobs for the free sessions, blocking for a batch window when idle"""
+        pending = []
+        if idle:
+            pending.append(self.jobs.get())
+            # Give concurrent requests a short window to join this batch
+            deadline = time.time() + BATCH_WINDOW_MS / 1000
+            while len(pending) < len(self.free_sessions):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        else:
+            while len(pending) < len(self.free_sessions):
+                try:
+                    pending.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+        return pending
+
+    def _run_each(self, fn, entries):
+        """Call fn on every entry (concurrently across sessions), returns per-entry errors"""
+        if self.executor is None or len(entries) == 1:
+            errors = []
+            for entry in entries:
+                try:
+                    fn(entry)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+            return errors
+        futures = [self.executor.submit(fn, entry) for entry in entries]
+        return [f.exception() for f in futures]
+
+    def _release(self, entry, error=None):
+        future, generation, started = entry
+        self.free_sessions.append(generation.session)
+        self.in_flight -= 1
+        self.completed += 1
+        self.service_times.append(time.time() - started)
+        try:
+            if error is not None:
+                future.set_exception(error)
+                return
+            try:
+                future.set_result(generation.finish())
+            except Exception as e:
+                future.set_exception(e)
+        finally:
+            self._done()
+
+    def _worker(self):
+        active = []  # (future, generation, started)
+        closing = False
+        while True:
+            admitted = []
+            if self.free_sessions:
+                for enqueued_at, future, generation in self._collect(idle=not active):
+                    if future is None:
+                        # close() sentinel, everything queued before it is still served
+                        closing = True
+                        continue
+                    if not future.set_running_or_notify_cancel():
+                        self.dropped += 1
+                        self._done()
+                        continue
+                    # Client gone or deadline passed while waiting: don't spend a prefill on it
+                    reason = generation.cancel.reason() if generation.cancel is not None else None
+                    if reason is not None:
+                        self.dropped += 1
+                        self._done()
+                        future.set_exception(RequestCancelledError("expired" if reason == "deadline" else reason))
+                        continue
+                    started = time.time()
+                    self.wait_times.append((started - enqueued_at) * 1000)
+                    self.in_flight += 1
+                    generation.session = self.free_sessions.pop()
+                    admitted.append((future, generation, started))
+
+            # Prefill newly admitted sequences
+            if admitted:
+                self.batch_sizes.append(len(admitted) + len(active))
+                errors = self._run_each(lambda e: e[1].start(e[1].session), admitted)
+                for entry, error in zip(admitted, errors):
+                    if error is not None:
+                        self._release(entry, error)
+                    else:
+                        active.append(entry)
+
+            # One decode step for every unfinished sequence, finished ones leave the batch
+            stepping = [e for e in active if not e[1].done]
+            errors = self._run_each(lambda e: e[1].step(), stepping)
+            failed = {id(e): error for e, error in zip(stepping, errors) if error is not None}
+            still_active = []
+            for entry in active:
+                if id(entry) in failed:
+                    self._release(entry, failed[id(entry)])
+                elif entry[1].done:
+                    self._release(entry)
+                else:
+                    still_active.append(entry)
+            active = still_active
+            if closing and not active and self.jobs.empty():
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                return
+
+    def get_stats(self):
+        avg_wait = sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0
+        avg_batch = sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0
+        return {
+            "depth": self.jobs.qsize(),
+            "maxSize": self.max_size,
+            "inFlight": self.in_flight,
+            "poolSize": len(self.sessions),
+            "batchWindowMs": BATCH_WINDOW_MS,
+            "avgBatchSize": round(avg_batch, 2),
+            "avgWaitMs": round(avg_wait, 1),
+            "lastWaitMs": round(self.wait_times[-1], 1) if self.wait_times else 0,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "dropped": self.dropped
+        }
+
+
+def _pin_worker_threads(cpus, threads):
+    """Pin this process to its CPU slice and size the CPU threadpools to match"""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            print(f"[WARN] CPU pinning failed: {e}")
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    # XNNPACK sizes its threadpool from the core count at load time, not the affinity mask
+    try:
+        from executorch.extension.pybindings import portable_lib
+        reset_threadpool = getattr(portable_lib, "_unsafe_reset_threadpool", None)
+        if reset_threadpool is not None:
+            reset_threadpool(threads)
+    except ImportError:
+        pass
+
+
+def inference_worker_main(conn, index, cpus, threads, model_path=MODEL_PATH):
+    """Entry point of an inference worker process: load the model once, then serve generations.
+
+    The .pte is opened through ExecuTorch's mmap data loader, so the weight pages are
+    backed by the page cache and shared read-only between all worker processes.
+    """
+    load_runtime()
+    _pin_worker_threads(cpus, threads)
+    # Trace spans recorded here show up under the worker's name
+    threading.current_thread().name = f"inference-{index}"
+    try:
+        session = ModelSession(model_path)
+        program = session.load()
+        if 'forward' not in program.method_names():
+            raise RuntimeError("forward() not available")
+        worker_tokenizer = LlamaTokenizer(TOKENIZER_PATH, program)
+        verify_prompt_segments(worker_tokenizer)
+        session.detect_prefill_mode()
+        session.warm_prefix(prompt_prefix_tokens(worker_tokenizer))
+    except Exception as e:
+        conn.send(("failed", None, str(e)[:200]))
+        return
+    sampler = GreedySampler(worker_tokenizer.eos_ids)
+    stop = StopCriteria()
+    draft = NgramDraft() if SPECULATIVE == "ngram" and session.full_logits else None
+    conn.send(("ready", None, {"loadMs": round(session.load_ms, 1), "prefillMode": session.prefill_mode,
+                               "speculative": draft is not None}))
+    pending = deque()
+    cancelled = set()
+
+    def poll():
+        """Take in messages that arrived during a generation, cancels apply right away"""
+        while conn.poll():
+            message = conn.recv()
+            if message[0] == "cancel":
+                cancelled.add(message[1])
+            else:
+                pending.append(message)
+
+    while True:
+        try:
+            kind, job_id, payload = pending.popleft() if pending else conn.recv()
+        except (EOFError, OSError):
+            return
+        if kind == "stop":
+            return
+        if kind == "cancel":
+            cancelled.add(job_id)
+            continue
+        prompt, want_text, job_stop, cancel, traced = payload
+        if cancel is not None and job_id in cancelled:
+            cancel.cancel()
+        reason = cancel.reason() if cancel is not None else None
+        if reason is not None:
+            conn.send(("cancelled", job_id, "expired" if reason == "deadline" else reason))
+            continue
+        conn.send(("started", job_id, None))
+        on_text = (lambda delta, job_id=job_id: conn.send(("text", job_id, delta))) if want_text else None
+        trace = Trace("worker") if traced else NULL_TRACE
+        generation = Generation(worker_tokenizer, prompt, on_text, job_stop or stop, sampler, draft, cancel, trace)
+        try:
+            generation.start(session)
+            while not generation.done:
+                try:
+                    poll()
+                except (EOFError, OSError):
+                    return
+                if cancel is not None and job_id in cancelled:
+                    cancel.cancel()
+                generation.step()
+            text = generation.finish()
+            spans = (trace.events, trace.threads) if traced else None
+            conn.send(("done", job_id, (text, generation.stats, session.get_prefix_cache_stats(), spans)))
+        except Exception as e:
+            conn.send(("error", job_id, str(e)))
+        # Jobs reach a worker in id order, older cancels can't matter any more
+        cancelled = {j for j in cancelled if j > job_id}
+
+
+class InferenceProcess:
+    """Parent-side handle of one inference worker process"""
+
+    def __init__(self, index, cpus, threads):
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.failed = None
+        self.jobs = OrderedDict()  # job_id -> (future, generation), in dispatch order
+        self.running = None  # (job_id, started)
+        self.cancels_sent = set()
+        self.completed = 0
+        self.restarts = 0
+        self.info = {}
+        self.prefix_cache = {}
+
+
+class ProcessPool:
+    """Inference across worker processes, each with its own resident ExecuTorch program.
+
+    Jobs go to the worker with the fewest outstanding generations. A worker that exits
+    or runs one generation longer than WORKER_TIMEOUT is killed and restarted: its
+    running job fails (the request falls back to keyword scoring) and its queued jobs
+    are dispatched again.
+    """
+
+    def __init__(self, workers, model_path=MODEL_PATH, max_size=QUEUE_MAX):
+        self.max_size = max_size
+        self.model_path = model_path
+        self.parallelism = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()
+        self.next_job_id = 0
+        self.completed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.closing = False
+        self.service_times = deque(maxlen=100)
+        self.workers = []
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        share = max(1, len(cpus) // workers)
+        for index in range(workers):
+            slice_ = cpus[index * share:(index + 1) * share] if len(cpus) >= workers else []
+            threads = WORKER_THREADS or max(1, len(slice_) or share)
+            self.workers.append(InferenceProcess(index, slice_, threads))
+        for worker in self.workers:
+            self._spawn(worker)
+        self.monitor = threading.Thread(target=self._monitor, name="worker-monitor", daemon=True)
+        self.monitor.start()
+        # Runs before multiprocessing terminates its children, so exits aren't restarted
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop the worker processes (no restarts from here on)"""
+        with self.lock:
+            self.closing = True
+            for worker in self.workers:
+                try:
+                    worker.conn.send(("stop", None, None))
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            worker.process.join(timeout=2)
+
+    def wait_ready(self, timeout=600):
+        """Block until every worker reported ready or failed, returns the ready count"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(w.ready or w.failed for w in self.workers):
+                break
+            time.sleep(0.1)
+        return sum(1 for w in self.workers if w.ready)
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=inference_worker_main, name=f"inference-{worker.index}",
+                                       args=(child_conn, worker.index, worker.cpus, worker.threads, self.model_path),
+                                       daemon=True)
+        process.start()
+        # Only the child keeps its end open, so recv() sees EOF when the child dies
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.ready = False
+        worker.failed = None
+        worker.running = None
+        reader = threading.Thread(target=self._read, args=(worker, parent_conn),
+                                  name=f"inference-{worker.index}-reader", daemon=True)
+        reader.start()
+
+    def submit(self, generation):
+        """Send a Generation's prompt to the least-loaded worker, returns a Future"""
+        future = Future()
+        with self.lock:
+            if self.closing:
+                raise QueueClosedError()
+            outstanding = sum(len(w.jobs) for w in self.workers)
+            if outstanding >= self.max_size + self.parallelism:
+                self.rejected += 1
+                raise QueueFullError(self.retry_after())
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            if not self._dispatch(job_id, future, generation):
+                future.set_exception(RuntimeError("no inference worker available"))
+        return future
+
+    def _dispatch(self, job_id, future, generation):
+        """Queue a job on the live worker with the fewest outstanding jobs (lock held)"""
+        candidates = [w for w in self.workers if not w.failed and not self.closing]
+        if not candidates:
+            return False
+        worker = min(candidates, key=lambda w: (len(w.jobs), not w.ready))
+        worker.jobs[job_id] = (future, generation)
+        try:
+            worker.conn.send(("generate", job_id, (generation.prompt, generation.on_text is not None,
+                                                   generation.stop, generation.cancel, generation.trace.enabled)))
+        except (OSError, ValueError):
+            # The reader thread notices the dead worker and re-dispatches its jobs
+            pass
+        return True
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained"""
+        if not self.service_times:
+            return RETRY_AFTER_SECONDS
+        avg_service = sum(self.service_times) / len(self.service_times)
+        backlog = sum(len(w.jobs) for w in self.workers) / self.parallelism
+        return max(1, math.ceil(backlog * avg_service))
+
+    def expected_wait_ms(self):
+        """Milliseconds a request submitted now should wait for the least-loaded worker"""
+        live = [len(w.jobs) for w in self.workers if not w.failed]
+        if not live or not min(live) or not self.service_times:
+            return 0
+        avg_service = sum(self.service_times) / len(self.service_times)
+        return min(live) * avg_service * 1000
+
+    def outstanding(self):
+        """Generations dispatched and not finished yet"""
+        with self.lock:
+            return sum(len(w.jobs) for w in self.workers)
+
+    def _read(self, worker, conn):
+        """Route messages from one worker process to the waiting futures"""
+        while True:
+            try:
+                kind, job_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                worker.ready = True
+                worker.info = payload
+                print(f"[OK] Inference worker {worker.index} ready (pid {worker.process.pid}, "
+                      f"cpus {worker.cpus or 'all'}, {worker.threads} threads, load {payload['loadMs']:.0f}ms)")
+            elif kind == "failed":
+                worker.failed = payload
+                print(f"[ERROR] Inference worker {worker.index} failed to load: {payload}")
+            elif kind == "started":
+                worker.running = (job_id, time.time())
+                entry = worker.jobs.get(job_id)
+                if entry is not None:
+                    entry[0].set_running_or_notify_cancel()
+            elif kind == "text":
+                entry = worker.jobs.get(job_id)
+                if entry is not None and entry[1].on_text is not None:
+                    entry[1].on_text(payload)
+            elif kind in ("done", "error", "cancelled"):
+                self._complete(worker, job_id, kind, payload)
+        self._on_exit(worker, conn)
+
+    def _complete(self, worker, job_id, kind, payload):
+        with self.lock:
+            entry = worker.jobs.pop(job_id, None)
+            started = worker.running[1] if worker.running and worker.running[0] == job_id else None
+            worker.running = None
+            worker.completed += 1
+            self.completed += 1
+            if started is not None:
+                self.service_times.append(time.time() - started)
+        if entry is None:
+            return
+        future, generation = entry
+        if kind == "cancelled":
+            self.dropped += 1
+        if future.cancelled():
+            # The caller stopped waiting (deadline), nothing to deliver
+            return
+        if kind == "error":
+            future.set_exception(RuntimeError(payload))
+            return
+        if kind == "cancelled":
+            future.set_exception(RequestCancelledError(payload))
+            return
+        text, generation.stats, worker.prefix_cache, spans = payload
+        generation.stop_reason = generation.stats["stopReason"]
+        if spans is not None:
+            events, threads = spans
+            # Waiting here and in the worker's pipe, up to its first span
+            first = min((e["ts"] for e in events), default=time.time() * 1e6) / 1e6
+            generation.trace.add("queue", generation.created_at, first, worker=worker.index)
+            generation.trace.merge(events, threads)
+        future.set_result(text)
+
+    def _on_exit(self, worker, conn):
+        """Fail the running job, restart the worker and re-dispatch what it had queued"""
+        with self.lock:
+            if worker.conn is not conn:
+                return
+            conn.close()
+            worker.process.join(timeout=1)
+            failed_to_load = worker.failed is not None or self.closing
+            running_id = worker.running[0] if worker.running else None
+            jobs = list(worker.jobs.items())
+            worker.jobs.clear()
+            if not failed_to_load:
+                worker.restarts += 1
+                self.restarts += 1
+                print(f"[WARN] Inference worker {worker.index} exited (code {worker.process.exitcode}), restarting")
+                self._spawn(worker)
+            for job_id, (future, generation) in jobs:
+                if job_id == running_id:
+                    future.set_exception(RuntimeError(f"inference worker {worker.index} died"))
+                elif self.closing or not self._dispatch(job_id, future, generation):
+                    future.set_exception(RuntimeError("no inference worker available"))
+
+    def _monitor(self):
+        """Kill workers stuck on one generation longer than WORKER_TIMEOUT, forward client disconnects"""
+        while not self.closing:
+            time.sleep(CLIENT_CHECK_MS / 1000)
+            self._forward_cancels()
+            for worker in self.workers:
+                running = worker.running
+                if running and time.time() - running[1] > WORKER_TIMEOUT and worker.process.is_alive():
+                    print(f"[WARN] Inference worker {worker.index} hung for {WORKER_TIMEOUT:.0f}s, killing")
+                    worker.process.kill()
+
+    def _forward_cancels(self):
+        """Tell workers about jobs whose client went away (only this process can probe the socket)"""
+        with self.lock:
+            for worker in self.workers:
+                for job_id, (future, generation) in worker.jobs.items():
+                    cancel = generation.cancel
+                    if cancel is None or cancel.probe is None or job_id in worker.cancels_sent:
+                        continue
+                    if cancel.reason() == "cancelled":
+                        worker.cancels_sent.add(job_id)
+                        try:
+                            worker.conn.send(("cancel", job_id, None))
+                        except (OSError, ValueError):
+                            pass
+                worker.cancels_sent &= set(worker.jobs)
+
+    def prefix_cache_stats(self):
+        """Prefix cache counters last reported by each worker, summed"""
+        stats = {"enabled": PREFIX_CACHE, "hits": 0, "misses": 0, "reusedTokens": 0}
+        for worker in self.workers:
+            for key in ("hits", "misses", "reusedTokens"):
+                stats[key] += worker.prefix_cache.get(key, 0)
+        return stats
+
+    def get_stats(self):
+        return {
+            "depth": sum(max(0, len(w.jobs) - 1) for w in self.workers),
+            "maxSize": self.max_size,
+            "inFlight": sum(1 for w in self.workers if w.running),
+            "poolSize": self.parallelism,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "restarts": self.restarts,
+            "workers": [{
+                "index": w.index,
+                "pid": w.process.pid if w.process else None,
+                "ready": w.ready,
+                "failed": w.failed,
+                "cpus": w.cpus,
+                "threads": w.threads,
+                "outstanding": len(w.jobs),
+                "completed": w.completed,
+                "restarts": w.restarts,
+                **w.info
+            } for w in self.workers]
+        }
+
+
+class Lexicon:
+    """Keyword set compiled once at startup.
+
+    found() only needs presence, where CPython's C substring search over the
+    prebuilt tuple measures faster than a regex scan at this lexicon size.
+    search() stops at the first hit of any keyword.
+    """
+
+    def __init__(self, words):
+        self.words = tuple(dict.fromkeys(words))
+        self.pattern = re.compile("|".join(re.escape(word) for word in self.words))
+
+    def found(self, text):
+        """Set of keywords present in (lowercased) text"""
+        return {word for word in self.words if word in text}
+
+    def search(self, text):
+        """True if any keyword occurs in text, stops at the first hit"""
+        return self.pattern.search(text) is not None
+
+
+# Keyword scorer weights (fallback and blend partner for the LLM score)
+KEYWORD_POSITIVE = {
+    'bamboo': 20, 'organic': 15, 'recycled': 15, 'sustainable': 15,
+    'eco-friendly': 15, 'biodegradable': 18, 'compostable': 18,
+    'reusable': 12, 'solar': 15, 'renewable': 15, 'fair-trade': 12,
+    'vegan': 10, 'natural': 8, 'hemp': 15, 'cork': 12, 'linen': 10,
+    'cotton': 5, 'wool': 5, 'certified': 10, 'b-corp': 12,
+    'carbon-neutral': 18, 'zero-waste': 15, 'upcycled': 12,
+    'plant-based': 12, 'cruelty-free': 10, 'ethical': 10,
+    'handmade': 8, 'local': 8, 'durable': 10, 'refillable': 12
+}
+
+KEYWORD_NEGATIVE = {
+    'plastic': -15, 'synthetic': -12, 'disposable': -18,
+    'single-use': -20, 'petroleum': -15, 'chemical': -10,
+    'toxic': -18, 'non-recyclable': -15, 'polyester': -10,
+    'nylon': -8, 'acrylic': -10, 'pvc': -15, 'vinyl': -12,
+    'styrofoam': -20, 'fast-fashion': -15, 'cheap': -5,
+    'mass-produced': -8, 'imported': -3, 'bleached': -8
+}
+
+# Signal words for classifying free-form LLM output
+POSITIVE_SIGNALS = [
+    'sustainable', 'organic', 'eco-friendly', 'recyclable', 'renewable',
+    'biodegradable', 'natural', 'ethical', 'fair trade', 'great',
+    'excellent', 'environmentally friendly', 'durable', 'compostable',
+    'certified', 'responsible', 'green', 'clean', 'safe', 'good choice'
+]
+
+NEGATIVE_SIGNALS = [
+    'plastic', 'toxic', 'harmful', 'pollut', 'waste', 'chemical',
+    'synthetic', 'non-recyclable', 'disposable', 'cheap', 'poor',
+    'unsustainable', 'bad', 'concern', 'problem', 'damage',
+    'non-renewable', 'petroleum', 'not recyclable', 'not biodegradable'
+]
+
+KEYWORD_LEXICON = Lexicon(list(KEYWORD_POSITIVE) + list(KEYWORD_NEGATIVE))
+POSITIVE_SIGNAL_LEXICON = Lexicon(POSITIVE_SIGNALS)
+NEGATIVE_SIGNAL_LEXICON = Lexicon(NEGATIVE_SIGNALS)
+
+
+# Sustainability prompt template - completion style for base model
+SUSTAINABILITY_PROMPT = """Product Review: {title}
+Materials: {materials}
+
+Sustainability Analysis:
+This product scores"""
+
+
+class ProductPrompt:
+    """Product fields packed into the prompt by token count instead of character slicing.
+
+    Fields are added in PRIORITY order, each up to its FIELD_TOKENS cap and within the
+    budget left after the template text. A field that doesn't fit is cut at a word
+    boundary, and fields without room for their first word are dropped. The layout is
+    SUSTAINABILITY_PROMPT with Brand and Details lines when those fields are present.
+    Every value becomes one segment with its leading space and trailing newlines, e.g.
+    " Bamboo Toothbrush\\n". Llama 3's pre-tokenizer splits before " word" and after a
+    newline run, so no token spans a segment boundary and the tokenizer's segment
+    cache can encode the labels once and reuse repeated values.
+    """
+
+    LINES = (("productTitle", "Product Review:"), ("brand", "Brand:"),
+             ("materials", "Materials:"), ("description", "Details:"))
+    PRIORITY = ("productTitle", "materials", "description", "brand")
+    FIELD_TOKENS = {"productTitle": 32, "materials": 24, "description": 96, "brand": 8}
+    DEFAULTS = {"productTitle": "Unknown", "materials": "Not specified"}
+    CLOSING = "Sustainability Analysis:\nThis product scores"
+
+    def __init__(self, product_data):
+        self.fields = {}
+        for field, _ in self.LINES:
+            value = " ".join(str(product_data.get(field) or "").split()) or self.DEFAULTS.get(field, "")
+            if value:
+                self.fields[field] = value
+
+    @staticmethod
+    def _fit(tokenizer, value, allowance):
+        """Longest word-boundary prefix of value whose " value\\n" segment fits allowance tokens,
+        None when not even the first word fits"""
+        # Candidates aren't cached: only the fitted segment pack() encodes is worth keeping
+        if len(tokenizer._encode_piece(f" {value}\n", cache=False)) <= allowance:
+            return value
+        tokens = tokenizer._encode_piece(f" {value}", cache=False)
+        keep = allowance - 1
+        while keep > 0:
+            text = tokenizer.decode(tokens[:keep]).rstrip('\ufffd').strip()
+            if not value.startswith(text + " "):
+                if " " not in text:
+                    # Shorter cuts are fragments of the first word too
+                    return None
+                text = text[:text.rfind(" ")].rstrip()
+            if text and len(tokenizer._encode_piece(f" {text}\n", cache=False)) <= allowance:
+                return text
+            keep -= 1
+        return None
+
+    def pack(self, tokenizer, budget):
+        """Prompt segments holding as much of the fields as fits in budget tokens"""
+        # BOS, the closing text and one token for the blank line before it
+        remaining = budget - 2 - len(tokenizer._encode_piece(self.CLOSING))
+        values = {}
+        for field in self.PRIORITY:
+            if field not in self.fields:
+                continue
+            label = dict(self.LINES)[field]
+            label_cost = len(tokenizer._encode_piece(label))
+            allowance = min(self.FIELD_TOKENS[field], remaining - label_cost)
+            value = self._fit(tokenizer, self.fields[field], allowance) if allowance >= 2 else None
+            if value is None:
+                continue
+            values[field] = value
+            remaining -= label_cost + len(tokenizer._encode_piece(f" {value}\n"))
+
+        segments = []
+        present = [(field, label) for field, label in self.LINES if field in values]
+        for i, (field, label) in enumerate(present):
+            # The blank line before the closing text belongs to the last value's newline run
+            newlines = "\n\n" if i == len(present) - 1 else "\n"
+            segments += [label, f" {values[field]}{newlines}"]
+        segments.append(self.CLOSING)
+        return segments
+
+    def encode(self, tokenizer, budget):
+        return tokenizer.encode_segments(self.pack(tokenizer, budget))[:budget]
+
+
+class ScorePrompt(ProductPrompt):
+    """ProductPrompt ending in "scores " so the next token is the score itself.
+
+    Generation stops after the prefill for these prompts and keeps the probabilities
+    of the number tokens 0..SCALE instead of decoding text.
+    """
+
+    CLOSING = ProductPrompt.CLOSING + " "
+    SCALE = 10
+    score_only = True
+
+    def read_score(self, tokenizer, logits, min_mass=LIKELIHOOD_MIN_MASS):
+        """Expected and most likely score (0-100) from the next-token logits.
+
+        None when the number tokens hold less than min_mass of the probability, e.g. the
+        model would continue with "85 out of 100" whose first token isn't one of 0..10.
+        """
+        import torch
+
+        probs = torch.softmax(logits.view(-1).float(), dim=-1)
+        # Numbers that are one token (all of 0..10 for Llama 3, 0..9 with the byte fallback)
+        numbers = {}
+        for value in range(self.SCALE + 1):
+            tokens = tokenizer._encode_piece(str(value))
+            if len(tokens) == 1:
+                numbers[value] = probs[tokens[0]].item()
+        mass = sum(numbers.values())
+        if mass <= 0 or mass < min_mass:
+            print(f"[LLM] Score tokens hold {mass:.1%} of the probability, likelihood score skipped")
+            return None
+        expected = sum(value * p for value, p in numbers.items()) / mass
+        return {
+            "expected": round(expected * 100 / self.SCALE, 1),
+            "argmax": max(numbers, key=numbers.get) * 100 // self.SCALE,
+            "numberMass": round(mass, 4)
+        }
+
+
+def prompt_prefix_tokens(tokenizer):
+    """Tokens of the fixed template header every prompt starts with"""
+    return tokenizer.encode(SUSTAINABILITY_PROMPT.split("{title}")[0].rstrip())
+
+
+def verify_prompt_segments(tokenizer):
+    """Check the segment cache against full encoding on a prompt with awkward boundaries"""
+    return tokenizer.verify_segments(ProductPrompt({
+        "productTitle": "Kids' 3-Pack Socks (Organic!)", "brand": "Darn-Tough's",
+        "materials": "100% cotton, élastane", "description": "Made in U.S.A.!!"
+    }).pack(tokenizer, 10 ** 6))
+
+
+class LatencyRouter:
+    """Picks the analysis tier that fits a request's latency budget.
+
+    "llm" when the expected queue wait plus a typical generation fits, "llm-short"
+    (decoding stops right after the score) when only that fits, "keyword" otherwise.
+    Estimates come from the prefill and per-token decode times of recent generations.
+    """
+
+    TIERS = ("llm", "llm-short", "keyword")
+
+    def __init__(self, default_budget_ms=LATENCY_BUDGET_MS, short_tokens=ROUTER_SHORT_TOKENS):
+        self.default_budget_ms = default_budget_ms
+        self.short_tokens = short_tokens
+        self.prefill_ms = deque(maxlen=100)
+        self.token_ms = deque(maxlen=100)
+        self.generated = deque(maxlen=100)
+        self.tiers = dict.fromkeys(self.TIERS, 0)
+        self.upgrades_queued = 0
+        self.upgrades_done = 0
+        self.upgrades_dropped = 0
+
+    def budget(self, product_data):
+        """Latency budget in ms for a request (0 = no budget)"""
+        try:
+            budget = float(product_data.get('latencyBudgetMs', self.default_budget_ms))
+        except (TypeError, ValueError):
+            budget = self.default_budget_ms
+        return max(0.0, budget)
 
+    def observe(self, stats, full=True):
+        """Record a finished generation; only full generations set the expected length"""
+        if "prefillMs" in stats:
+            self.prefill_ms.append(stats["prefillMs"])
+        tokens = stats.get("generatedTokens", 0)
+        if tokens and "decodeMs" in stats:
+            self.token_ms.append(stats["decodeMs"] / tokens)
+        if full and tokens:
+            self.generated.append(tokens)
 
-# Sustainability prompt template - completion style for base model
-SUSTAINABILITY_PROMPT = """Product Review: {title}
-Materials: {materials}
+    def estimate(self, queue_):
+        """Expected wait, prefill, per-token decode and generation length (None before any data)"""
+        if not self.prefill_ms:
+            return None
+        return {
+            "waitMs": round(queue_.expected_wait_ms(), 1),
+            "prefillMs": percentile(list(self.prefill_ms), 50),
+            "tokenMs": round(percentile(list(self.token_ms), 50), 2) if self.token_ms else None,
+            "tokens": percentile(list(self.generated), 50) or self.short_tokens
+        }
 
-Sustainability Analysis:
-This product scores"""
+    def route(self, product_data, queue_, prefill_only=False):
+        """Returns (tier, StopCriteria for the generation or None for the default).
+
+        prefill_only requests (likelihood scoring) have no decode to shorten.
+        """
+        budget = self.budget(product_data)
+        estimate = self.estimate(queue_) if budget else None
+        if estimate is None:
+            return "llm", None
+        # The stop budget is measured from the start of prefill, so it excludes the wait
+        fixed = estimate["waitMs"] + estimate["prefillMs"]
+        if prefill_only:
+            return ("llm" if fixed <= budget else "keyword"), None
+        if estimate["tokenMs"] is None:
+            return "llm", None
+        if fixed + estimate["tokens"] * estimate["tokenMs"] <= budget:
+            return "llm", None
+        if fixed + self.short_tokens * estimate["tokenMs"] <= budget:
+            return "llm-short", StopCriteria(sentences_after_score=0, budget_ms=budget - estimate["waitMs"])
+        return "keyword", None
+
+    def reset(self):
+        """Forget the timing samples (the model behind them changed)"""
+        self.prefill_ms.clear()
+        self.token_ms.clear()
+        self.generated.clear()
+
+    def count(self, tier):
+        self.tiers[tier] += 1
+        METRICS.inc("greenlane_router_tier_total", tier=tier)
+
+    def get_stats(self, queue_=None):
+        return {
+            "defaultBudgetMs": self.default_budget_ms,
+            "shortTokens": self.short_tokens,
+            "tiers": dict(self.tiers),
+            "estimate": self.estimate(queue_) if queue_ is not None else None,
+            "upgradesQueued": self.upgrades_queued,
+            "upgradesDone": self.upgrades_done,
+            "upgradesDropped": self.upgrades_dropped
+        }
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB (None without /proc)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * mmap.PAGESIZE / (1024 * 1024), 1)
+
+
+class ModelRegistry:
+    """The .pte variants found in the model directory and which one is served.
+
+    With more than one variant and MODEL_VARIANT=fastest, every variant is loaded once at
+    startup, decodes a few tokens and scores two probe products by likelihood, then is
+    released again. The fastest variant that passes the quality check wins.
+    """
+
+    BACKENDS = ("xnnpack", "portable", "coreml", "mps", "qnn", "vulkan")
+    # Quality probes: an eco-friendly variant must score the first above the second
+    PROBES = (
+        {"productTitle": "Bamboo Toothbrush", "materials": "organic bamboo, plant-based bristles",
+         "description": "Biodegradable handle, plastic-free recycled cardboard packaging"},
+        {"productTitle": "Disposable Plastic Cutlery 500 Pack", "materials": "polystyrene plastic",
+         "description": "Single-use, not recyclable, shrink-wrapped"},
+    )
+
+    def __init__(self, model_dir=MODEL_DIR, default_path=MODEL_PATH, selection=MODEL_VARIANT):
+        self.default_path = default_path
+        self.selection = selection
+        self.active = None
+        self.variants = OrderedDict()
+        paths = sorted(model_dir.glob("*.pte")) if model_dir.exists() else []
+        for path in paths:
+            backend = next((b for b in self.BACKENDS if b in path.stem.lower()), None)
+            self.variants[path.stem] = {
+                "name": path.stem,
+                "path": path,
+                "sizeMb": round(path.stat().st_size / (1024 * 1024), 1),
+                "backend": backend,
+                "loadMs": None,
+                "rssMb": None,
+                "maxSeqLen": None,
+                "prefillMode": None,
+                "prefillTokPerSec": None,
+                "decodeTokPerSec": None,
+                "quality": None,
+                "error": None
+            }
+
+    def select(self, tokenizer_path=TOKENIZER_PATH):
+        """Path of the variant to serve, benchmarking the candidates if there is a choice"""
+        if not self.variants:
+            return self.default_path
+        if self.selection in self.variants:
+            return self.variants[self.selection]["path"]
+        if self.selection != "fastest":
+            print(f"[WARN] MODEL_VARIANT={self.selection} not found in {list(self.variants)}, picking the fastest")
+        default = self.variants.get(self.default_path.stem)
+        if len(self.variants) == 1:
+            return next(iter(self.variants.values()))["path"]
+
+        print(f"[INFO] Benchmarking {len(self.variants)} model variants ({VARIANT_BENCH_TOKENS} decode steps each)...")
+        tokenizer_ = None
+        for variant in self.variants.values():
+            tokenizer_ = self.benchmark(variant, tokenizer_, tokenizer_path)
+        loaded = [v for v in self.variants.values() if v["error"] is None and v["decodeTokPerSec"]]
+        passed = [v for v in loaded if v["quality"] and v["quality"]["passed"]]
+        if not loaded:
+            print("[WARN] No model variant ran the benchmark")
+            return (default or next(iter(self.variants.values())))["path"]
+        if not passed:
+            print("[WARN] No model variant passed the quality check, serving the fastest one")
+        best = max(passed or loaded, key=lambda v: v["decodeTokPerSec"])
+        print(f"[OK] Model variant: {best['name']} ({best['decodeTokPerSec']} tok/s)")
+        return best["path"]
+
+    def benchmark(self, variant, tokenizer_=None, tokenizer_path=TOKENIZER_PATH):
+        """Load a variant, time its prefill and decode, run the quality probes and release it.
+
+        Returns the tokenizer, which is read once from the first variant that loads.
+        """
+        session = ModelSession(variant["path"])
+        rss_before = current_rss_mb()
+        try:
+            session.load()
+            if 'forward' not in session.program.method_names():
+                raise RuntimeError("forward() not available")
+            if tokenizer_ is None:
+                tokenizer_ = LlamaTokenizer(tokenizer_path, session.program)
+            session.detect_prefill_mode()
+            sampler = GreedySampler(tokenizer_.eos_ids)
+
+            generation = Generation(tokenizer_, ProductPrompt(self.PROBES[0]), sampler=sampler)
+            generation.start(session)
+            started = time.time()
+            while not generation.done and len(generation.generated) < VARIANT_BENCH_TOKENS:
+                generation.step()
+            decode_s = time.time() - started
+            steps = max(0, len(generation.generated) - 1)
+
+            scores = []
+            for probe in self.PROBES:
+                scoring = Generation(tokenizer_, ScorePrompt(probe), sampler=sampler)
+                scoring.start(session)
+                scores.append(scoring.likelihood["expected"] if scoring.likelihood else None)
+            gap = scores[0] - scores[1] if None not in scores else None
+
+            rss_after = current_rss_mb()
+            variant.update({
+                "loadMs": round(session.load_ms, 1),
+                "rssMb": round(rss_after - rss_before, 1) if rss_before is not None else None,
+                "maxSeqLen": session.max_seq_len,
+                "prefillMode": session.prefill_mode,
+                "prefillTokPerSec": round(len(generation.tokens) / generation.prefill_ms * 1000, 1)
+                                    if generation.prefill_ms else None,
+                "decodeTokPerSec": round(steps / decode_s, 1) if steps and decode_s > 0 else None,
+                "quality": {"ecoScore": scores[0], "plasticScore": scores[1],
+                            "gap": round(gap, 1) if gap is not None else None,
+                            "passed": gap is not None and gap > VARIANT_MIN_SCORE_GAP},
+                "error": None
+            })
+            print(f"[BENCH] {variant['name']}: load {variant['loadMs']:.0f} ms, "
+                  f"decode {variant['decodeTokPerSec']} tok/s, score gap {variant['quality']['gap']}")
+        except Exception as e:
+            variant["error"] = str(e)[:200]
+            print(f"[WARN] Model variant {variant['name']} failed: {variant['error']}")
+        finally:
+            # Only the served variant stays resident
+            session.program = None
+            session.resident = []
+        return tokenizer_
+
+    def mark_active(self, path, load_ms=None):
+        """Record the variant now being served (load time from the serving load if not benchmarked)"""
+        variant = self.variants.get(Path(path).stem)
+        self.active = Path(path).stem
+        if variant is not None and variant["loadMs"] is None and load_ms:
+            variant["loadMs"] = round(load_ms, 1)
+
+    def get_stats(self, live_tok_per_sec=None):
+        variants = []
+        for variant in self.variants.values():
+            entry = {**variant, "path": str(variant["path"]), "active": variant["name"] == self.active}
+            if entry["active"] and live_tok_per_sec:
+                entry["liveDecodeTokPerSec"] = live_tok_per_sec
+            variants.append(entry)
+        return {
+            "selection": self.selection,
+            "active": self.active,
+            "benchTokens": VARIANT_BENCH_TOKENS,
+            "minScoreGap": VARIANT_MIN_SCORE_GAP,
+            "variants": variants
+        }
 
 
 class SustainabilityAnalyzer:
     """Analyzes products using ExecuTorch + Llama 3.2"""
     
+    # Stop reasons of generations that ended before the model was done
+    TRUNCATED_STOPS = ("deadline", "time_budget", "cancelled")
+    
     def __init__(self):
-        global model, tokenizer, model_load_error, CAN_INFER
-        
         self.model = None
+        self.registry = ModelRegistry()
+        self.model_path = MODEL_PATH
+        self.session = ModelSession(MODEL_PATH)
         self.tokenizer = None
         self.model_loaded = False
         self.can_infer = False
-        self.inference_times = []
+        self.inference_times = deque(maxlen=METRICS_WINDOW)
+        self.total_inferences = 0
         self.model_size_gb = 0
+        self.result_cache = ResultCache()
+        self.stop_criteria = StopCriteria()
+        self.router = LatencyRouter()
+        # Background LLM runs that replace keyword answers in the result cache
+        self.upgrade_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upgrade")
+        self.upgrades_pending = set()
+        self.upgrade_lock = threading.Lock()
+        self.sampler = None
+        self.draft = None
+        self.sessions = [self.session]
+        self.queue = None
+        self.weights = WeightsMapping(MODEL_PATH)
+        # Held while a hot swap loads the next variant
+        self.swap_lock = threading.Lock()
+        self.swaps = 0
+        
+        # Set once warm_up() has finished, whether or not the model could be loaded
+        self.ready = False
+        self.startup = {
+            "phase": "starting",
+            "loadMode": MODEL_LOAD_MODE,
+            "importMs": None,
+            "variantBenchMs": None,
+            "prefaultMs": None,
+            "loadMs": None,
+            "tokenizerMs": None,
+            "firstForwardMs": None,
+            "poolMs": None,
+            "listeningAfterMs": None,
+            "readyAfterMs": None
+        }
+    
+    def _startup_phase(self, phase, key=None, started=None):
+        """Record a finished startup stage in the timeline and move on to the next phase"""
+        if key is not None:
+            self.startup[key] = round((time.time() - started) * 1000, 1)
+        self.startup["phase"] = phase
+    
+    def warm_up(self):
+        """Import the runtime, load model and tokenizer and run the first forward.
+
+        Requests are answered with keyword scoring until this sets can_infer.
+        """
+        global model, tokenizer, model_load_error, CAN_INFER
+        
+        self.startup["phase"] = "import"
+        started = time.time()
+        load_runtime()
+        self._startup_phase("variants", "importMs", started)
+        can_infer = False
+        queue_ = None
+
+        # Pick the model variant to serve (benchmarks them when there is a choice)
+        started = time.time()
+        if executorch_available:
+            self.model_path = self.registry.select()
+            self.session = ModelSession(self.model_path)
+            self.sessions = [self.session]
+            self.weights = WeightsMapping(self.model_path)
+        self._startup_phase("load", "variantBenchMs", started)
+        model_path = self.model_path
         
-        # Load ExecuTorch model
-        if executorch_available and MODEL_PATH.exists():
-            self.model_size_gb = MODEL_PATH.stat().st_size / (1024**3)
-            print(f"\n[INFO] Loading Llama 3.2 1B ({self.model_size_gb:.2f} GB)...")
+        # Load ExecuTorch model (in the worker processes when INFERENCE_WORKERS is set)
+        if executorch_available and model_path.exists():
+            self.model_size_gb = model_path.stat().st_size / (1024**3)
+            self.startup["prefaultMs"] = round(self.weights.open(), 1)
+        started = time.time()
+        if INFERENCE_WORKERS > 0 and executorch_available and model_path.exists():
+            print(f"\n[INFO] Starting {INFERENCE_WORKERS} inference worker(s) for {model_path.name} ({self.model_size_gb:.2f} GB, shared mmap)...")
+            queue_ = ProcessPool(INFERENCE_WORKERS, model_path)
+            ready = queue_.wait_ready()
+            self.model_loaded = can_infer = ready > 0
+            if ready:
+                print(f"[OK] {ready}/{INFERENCE_WORKERS} inference worker(s) ready")
+            else:
+                model_load_error = "No inference worker could load the model"
+                print(f"[ERROR] {model_load_error}")
+        elif executorch_available and model_path.exists():
+            print(f"\n[INFO] Loading {model_path.name} ({self.model_size_gb:.2f} GB, {MODEL_LOAD_MODE})...")
             
             try:
-                self.model = _load_for_executorch(str(MODEL_PATH))
+                self.model = self.session.load()
                 self.model_loaded = True
+                print(f"[OK] Model loaded in {self.session.load_ms / 1000:.1f}s (resident, KV reset: {KV_RESET_MODE})")
                 model = self.model
                 
                 # Check if forward() works
@@ -165,8 +2610,7 @@ class SustainabilityAnalyzer:
                     print(f"[OK] Methods: {methods}")
                 
                 if 'forward' in methods:
-                    self.can_infer = True
-                    CAN_INFER = True
+                    can_infer = True
                     print("[OK] Full LLM inference available!")
                 else:
                     print("[WARN] forward() not available")
@@ -176,113 +2620,232 @@ class SustainabilityAnalyzer:
                 model_load_error = error_msg[:200]
                 print(f"[ERROR] Model load failed: {error_msg[:200]}")
         else:
-            if not MODEL_PATH.exists():
-                model_load_error = f"Model not found at {MODEL_PATH}"
+            if not model_path.exists():
+                model_load_error = f"Model not found at {model_path}"
                 print(f"[WARN] {model_load_error}")
+        self._startup_phase("tokenizer", "loadMs", started)
         
         # Load tokenizer (after model so we can get metadata)
+        started = time.time()
         self.tokenizer = LlamaTokenizer(TOKENIZER_PATH, self.model)
+        verify_prompt_segments(self.tokenizer)
         tokenizer = self.tokenizer
+        self.sampler = GreedySampler(self.tokenizer.eos_ids)
+        self._startup_phase("first-forward", "tokenizerMs", started)
+
+        # Extra resident programs for micro-batching, stepped in lockstep with the first
+        if can_infer and queue_ is None:
+            timings = {}
+            self.sessions, self.draft = self._session_pool(self.session, timings)
+            queue_ = InferenceQueue(self.sessions)
+            self.startup.update(timings)
+        self._startup_phase("ready")
+        if can_infer:
+            self.registry.mark_active(model_path, self._backend_load_ms(queue_))
+
+        # Publish last, so no request sees a half-initialized model
+        self.queue = queue_
+        self.can_infer = CAN_INFER = can_infer
+        self.startup["readyAfterMs"] = round((time.time() - PROCESS_START) * 1000, 1)
+        self.ready = True
+        print(f"[OK] Ready {self.startup['readyAfterMs'] / 1000:.1f}s after start "
+              f"({'LLM' if can_infer else 'keyword fallback'})")
     
-    def _run_llm_inference(self, prompt):
-        """Run actual Llama 3.2 inference via ExecuTorch"""
-        import torch
-        
-        # Reload model to reset KV cache state
+    def _session_pool(self, first, timings=None):
+        """Detect the export's features on a loaded session, load the rest of the pool and warm
+        the prompt prefix. Returns (sessions, n-gram draft or None).
+
+        If timings is a dict it gets firstForwardMs (the probe and the first session's prefix
+        prefill) and poolMs (loading and warming the other sessions).
+        """
+        started = time.time()
+        print(f"[OK] Prefill mode: {first.detect_prefill_mode()}")
+        forward_s = time.time() - started
+        draft = None
+        if SPECULATIVE == "ngram":
+            if first.full_logits:
+                draft = NgramDraft()
+                print(f"[OK] Speculative decoding: n-gram draft, {SPECULATIVE_TOKENS} tokens per step")
+            else:
+                print("[INFO] Speculative decoding needs an export with full logits, disabled")
+        started = time.time()
+        sessions = [first]
+        for i in range(1, MODEL_POOL_SIZE):
+            try:
+                extra = ModelSession(first.model_path)
+                extra.load()
+                extra.prefill_mode = first.prefill_mode
+                extra.full_logits = first.full_logits
+                sessions.append(extra)
+            except Exception as e:
+                print(f"[WARN] Model pool stopped at {len(sessions)} sessions: {e}")
+                break
+        print(f"[OK] Model pool: {len(sessions)} session(s)")
+
+        # Prefill the fixed template header once, requests resume after it
+        pool_s = time.time() - started
         try:
-            self.model = _load_for_executorch(str(MODEL_PATH))
+            prefix_tokens = prompt_prefix_tokens(self.tokenizer)
+            for session in sessions:
+                started = time.time()
+                session.warm_prefix(prefix_tokens)
+                if session is first:
+                    forward_s += time.time() - started
+                else:
+                    pool_s += time.time() - started
         except Exception as e:
-            print(f"[ERROR] Model reload failed: {e}")
-            return None
-        
-        # Tokenize (encode already prepends BOS)
-        tokens = self.tokenizer.encode(prompt)
-        
-        # Model max_seq_len=128, reserve space for generation
-        max_ctx = 90  # Leave room for ~38 generated tokens
-        if len(tokens) > max_ctx:
-            tokens = tokens[:max_ctx]
-        
-        # Generate tokens auto-regressively
-        generated = []
-        max_new_tokens = 128 - len(tokens) - 1  # Don't exceed model context
-        
-        start_time = time.time()
-        
+            print(f"[WARN] Prefix cache warm-up failed: {e}")
+        if timings is not None:
+            timings["firstForwardMs"] = round(forward_s * 1000, 1)
+            timings["poolMs"] = round(pool_s * 1000, 1)
+        return sessions, draft
+
+    @staticmethod
+    def _backend_load_ms(queue_):
+        """Model load time of an inference backend (slowest worker for a process pool)"""
+        if isinstance(queue_, ProcessPool):
+            return max((w.info.get("loadMs", 0) for w in queue_.workers), default=0)
+        return queue_.sessions[0].load_ms if queue_ is not None else 0
+
+    def swap_model(self, name):
+        """Serve another model variant without dropping requests.
+
+        The new variant is loaded next to the current one; once it is ready new requests
+        go to it, and the old backend is released after its queued and running
+        generations finished. Raises KeyError for an unknown variant, RuntimeError when
+        a swap is already running or the variant fails to load.
+        """
+        global model, CAN_INFER
+        variant = self.registry.variants[name]
+        if not self.swap_lock.acquire(blocking=False):
+            raise RuntimeError("a model swap is already in progress")
         try:
-            # Process prefill (all prompt tokens one at a time with KV cache)
-            for i, tok in enumerate(tokens):
-                # Token must be 2D [1, 1], position must be 1D [1]
-                token_tensor = torch.tensor([[tok]], dtype=torch.long)
-                pos_tensor = torch.tensor([i], dtype=torch.long)
-                
-                # ExecuTorch Llama forward: inputs=[token, position]
-                outputs = self.model.run_method("forward", [token_tensor, pos_tensor])
-                
-            # Get logits from last prefill step
-            if isinstance(outputs, (list, tuple)):
-                logits = outputs[0]
+            if not self.ready or self.tokenizer is None:
+                raise RuntimeError("server is still starting")
+            started = time.time()
+            path = variant["path"]
+            print(f"[INFO] Swapping model to {name}...")
+            weights = WeightsMapping(path)
+            weights.open()
+            if INFERENCE_WORKERS > 0:
+                queue_ = ProcessPool(INFERENCE_WORKERS, path)
+                if not queue_.wait_ready():
+                    queue_.close()
+                    raise RuntimeError(f"no inference worker could load {name}")
+                sessions, draft = self.sessions, self.draft
             else:
-                logits = outputs
-            
-            # Flatten logits and get next token (suppress EOS for base model)
-            logits_flat = logits.view(-1).float()
-            # Mask EOS tokens to prevent premature stopping
-            for eos_id in self.tokenizer.eos_ids:
-                if eos_id < logits_flat.shape[0]:
-                    logits_flat[eos_id] = float('-inf')
-            next_token = torch.argmax(logits_flat).item()
-            generated.append(next_token)
-            
-            # Auto-regressive generation
-            cur_pos = len(tokens)
-            for i in range(max_new_tokens - 1):
-                # Check for EOS
-                if next_token in self.tokenizer.eos_ids:
-                    break
-                
-                # Don't exceed model context
-                if cur_pos >= 127:
-                    break
-                
-                token_tensor = torch.tensor([[next_token]], dtype=torch.long)
-                pos_tensor = torch.tensor([cur_pos], dtype=torch.long)
-                
-                outputs = self.model.run_method("forward", [token_tensor, pos_tensor])
-                
-                if isinstance(outputs, (list, tuple)):
-                    logits = outputs[0]
-                else:
-                    logits = outputs
-                
-                logits_flat = logits.view(-1).float()
-                # Suppress EOS tokens
-                for eos_id in self.tokenizer.eos_ids:
-                    if eos_id < logits_flat.shape[0]:
-                        logits_flat[eos_id] = float('-inf')
-                next_token = torch.argmax(logits_flat).item()
-                generated.append(next_token)
-                cur_pos += 1
-            
-            elapsed = time.time() - start_time
-            
-            # Remove EOS tokens from output
-            generated = [t for t in generated if t not in self.tokenizer.eos_ids]
-            
-            # Decode generated tokens
-            output_text = self.tokenizer.decode(generated)
-            
-            tokens_per_sec = len(generated) / elapsed if elapsed > 0 else 0
-            print(f"[LLM] Generated {len(generated)} tokens in {elapsed:.1f}s ({tokens_per_sec:.1f} tok/s)")
-            
+                first = ModelSession(path)
+                program = first.load()
+                if 'forward' not in program.method_names():
+                    raise RuntimeError(f"{name}: forward() not available")
+                sessions, draft = self._session_pool(first)
+                queue_ = InferenceQueue(sessions)
+
+            # Publish: requests from here on run on the new variant
+            old_queue, old_sessions, old_weights = self.queue, self.sessions, self.weights
+            self.sessions, self.session, self.draft = sessions, sessions[0], draft
+            self.weights = weights
+            self.model_path = path
+            self.model_size_gb = path.stat().st_size / (1024**3)
+            if INFERENCE_WORKERS <= 0:
+                self.model = model = sessions[0].program
+            self.queue = queue_
+            self.model_loaded = True
+            self.can_infer = CAN_INFER = True
+            # Latency estimates describe the old variant
+            self.router.reset()
+            self.registry.mark_active(path, self._backend_load_ms(queue_))
+            self.swaps += 1
+            swap_ms = round((time.time() - started) * 1000, 1)
+            print(f"[OK] Now serving {name} (swap took {swap_ms / 1000:.1f}s)")
+
+            if old_queue is not None:
+                threading.Thread(target=self._retire, args=(old_queue, old_sessions, old_weights),
+                                 name="model-retire", daemon=True).start()
+            return {"active": name, "swapMs": swap_ms, "swaps": self.swaps}
+        finally:
+            self.swap_lock.release()
+
+    @staticmethod
+    def _retire(queue_, sessions, weights):
+        """Release a swapped-out backend once its in-flight generations are done"""
+        # Late submitters get QueueClosedError from here on and move to the new backend
+        while queue_.outstanding():
+            time.sleep(0.1)
+        queue_.close()
+        if isinstance(queue_, ProcessPool):
+            # Already stopped, the exit hook would only keep the retired pool alive
+            atexit.unregister(queue_.close)
+        else:
+            # Anything submitted before close() is served first, then the worker exits
+            queue_.worker.join()
+            for session in sessions:
+                session.program = None
+                session.resident = []
+        weights.close()
+        print("[OK] Previous model variant released")
+
+    def _run_llm_inference(self, prompt, on_text=None, info=None, stop=None, cancel=None, trace=None):
+        """Run actual Llama 3.2 inference via ExecuTorch on the inference worker.
+
+        If info is a dict it is filled with generation details (stop reason, token counts).
+        stop overrides the default StopCriteria (the router's shortened tier). cancel is the
+        request's CancelToken: a disconnected client raises RequestCancelledError, a passed
+        deadline ends decoding early with stop reason "deadline". trace, when enabled, gets
+        the queue, setup, tokenize, prefill, decode and per-forward spans.
+        """
+        # QueueFullError propagates so the handler can answer 503
+        generation = Generation(self.tokenizer, prompt, on_text, stop or self.stop_criteria, self.sampler,
+                                self.draft, cancel, trace)
+        while True:
+            try:
+                future = self.queue.submit(generation)
+                break
+            except QueueClosedError:
+                # Read the queue just before a model swap retired it, the new one takes over
+                time.sleep(0.001)
+        try:
+            output_text = self._wait(future, cancel)
+            if generation.stop_reason == "cancelled":
+                raise RequestCancelledError("cancelled")
+            if generation.stop_reason == "deadline":
+                METRICS.inc("greenlane_cancelled_total", reason="deadline")
+            stats = generation.stats or {}
+            self.router.observe(stats, full=stop is None and generation.stop_reason != "deadline")
+            for stage in ("tokenize", "prefill", "decode"):
+                if f"{stage}Ms" in stats:
+                    METRICS.observe(stage, stats[f"{stage}Ms"] / 1000)
+            METRICS.inc("greenlane_prompt_tokens_total", stats.get("promptTokens", 0))
+            METRICS.inc("greenlane_generated_tokens_total", stats.get("generatedTokens", 0))
+            METRICS.inc("greenlane_decode_forwards_total", stats.get("forwards", 0))
+            METRICS.inc("greenlane_draft_proposed_tokens_total", stats.get("draftProposed", 0))
+            METRICS.inc("greenlane_draft_accepted_tokens_total", stats.get("draftAccepted", 0))
+            if info is not None:
+                info.update(stats)
             return output_text
-            
+        except RequestCancelledError as e:
+            METRICS.inc("greenlane_cancelled_total", reason=e.reason)
+            raise
         except Exception as e:
+            METRICS.inc("greenlane_errors_total", kind="inference")
             print(f"[ERROR] Inference failed: {e}")
             import traceback
             traceback.print_exc()
             return None
     
+    @staticmethod
+    def _wait(future, cancel):
+        """Result of a queued generation; gives up at the deadline if it hasn't started by then"""
+        if cancel is None or cancel.deadline is None:
+            return future.result()
+        try:
+            return future.result(timeout=max(0, cancel.deadline - time.time()))
+        except FutureTimeoutError:
+            # A started generation stops itself at the deadline, a waiting one is withdrawn
+            if future.cancel():
+                raise RequestCancelledError("expired")
+            return future.result()
+    
     def _parse_llm_response(self, text, product_data=None):
         """Extract sustainability insights from LLM response (handles free-form text)"""
         # Try direct JSON parse
@@ -306,21 +2869,8 @@ class SustainabilityAnalyzer:
         # Extract insights from free-form text (base model output)
         text_lower = text.lower()
         
-        positive_signals = [
-            'sustainable', 'organic', 'eco-friendly', 'recyclable', 'renewable',
-            'biodegradable', 'natural', 'ethical', 'fair trade', 'great',
-            'excellent', 'environmentally friendly', 'durable', 'compostable',
-            'certified', 'responsible', 'green', 'clean', 'safe', 'good choice'
-        ]
-        negative_signals = [
-            'plastic', 'toxic', 'harmful', 'pollut', 'waste', 'chemical',
-            'synthetic', 'non-recyclable', 'disposable', 'cheap', 'poor',
-            'unsustainable', 'bad', 'concern', 'problem', 'damage',
-            'non-renewable', 'petroleum', 'not recyclable', 'not biodegradable'
-        ]
-        
         # Try to extract numeric score from LLM output
-        score_match = re.search(r'(\d+)\s*(?:out of|/)\s*(\d+)', text_lower)
+        score_match = SCORE_PATTERN.search(text_lower)
         if score_match:
             numerator = int(score_match.group(1))
             denominator = int(score_match.group(2))
@@ -328,8 +2878,8 @@ class SustainabilityAnalyzer:
                 score = int((numerator / denominator) * 100)
                 score = max(5, min(95, score))
         else:
-            pos_count = sum(1 for w in positive_signals if w in text_lower)
-            neg_count = sum(1 for w in negative_signals if w in text_lower)
+            pos_count = len(POSITIVE_SIGNAL_LEXICON.found(text_lower))
+            neg_count = len(NEGATIVE_SIGNAL_LEXICON.found(text_lower))
             
             base = 50
             score = base + (pos_count * 8) - (neg_count * 10)
@@ -342,8 +2892,8 @@ class SustainabilityAnalyzer:
         negatives = []
         for s in sentences[:6]:
             s_lower = s.lower()
-            neg_hit = any(w in s_lower for w in negative_signals)
-            pos_hit = any(w in s_lower for w in positive_signals)
+            neg_hit = NEGATIVE_SIGNAL_LEXICON.search(s_lower)
+            pos_hit = POSITIVE_SIGNAL_LEXICON.search(s_lower)
             # Classify: if it mentions negative material, it's a concern
             if neg_hit:
                 negatives.append(s[:80])
@@ -355,60 +2905,69 @@ class SustainabilityAnalyzer:
         if not negatives:
             negatives = ["Further research recommended"]
         
-        if score >= 70:
-            rec = "Good sustainable choice based on AI analysis."
-        elif score >= 45:
-            rec = "Moderate sustainability. Consider greener alternatives."
-        elif score >= 25:
-            rec = "Low sustainability. Look for eco-friendly options."
-        else:
-            rec = "Poor sustainability. Strongly consider alternatives."
-        
         return {
             "greenScore": score,
             "positives": positives[:3],
             "negatives": negatives[:3],
-            "recommendation": rec,
+            "recommendation": self._llm_recommendation(score),
             "llmOutput": text[:200]
         }
     
+    @staticmethod
+    def _llm_recommendation(score):
+        if score >= 70:
+            return "Good sustainable choice based on AI analysis."
+        elif score >= 45:
+            return "Moderate sustainability. Consider greener alternatives."
+        elif score >= 25:
+            return "Low sustainability. Look for eco-friendly options."
+        else:
+            return "Poor sustainability. Strongly consider alternatives."
+    
+    def _likelihood_result(self, product_data, likelihood):
+        """Result from the model's score distribution, positives/negatives from the lexicons"""
+        if not likelihood:
+            return None
+        kw_result = self._keyword_analysis(product_data)
+        llm_score = max(5, min(95, int(likelihood["expected"])))
+        # Same 60/40 blend with the keyword score as generated answers
+        blended = max(0, min(100, int(llm_score * 0.6 + kw_result['greenScore'] * 0.4)))
+        return {
+            "greenScore": blended,
+            "positives": kw_result['positives'],
+            "negatives": kw_result['negatives'],
+            "recommendation": self._llm_recommendation(blended),
+            "likelihood": likelihood
+        }
+    
+    @staticmethod
+    def _keyword_text(product_data):
+        return f"{product_data.get('productTitle', '')} {product_data.get('brand', '')} {product_data.get('materials', '')} {product_data.get('description', '')}".lower()
+    
     def _keyword_analysis(self, product_data):
         """Fallback keyword-based analysis"""
-        text = f"{product_data.get('productTitle', '')} {product_data.get('brand', '')} {product_data.get('materials', '')} {product_data.get('description', '')}".lower()
-        
-        positive = {
-            'bamboo': 20, 'organic': 15, 'recycled': 15, 'sustainable': 15,
-            'eco-friendly': 15, 'biodegradable': 18, 'compostable': 18,
-            'reusable': 12, 'solar': 15, 'renewable': 15, 'fair-trade': 12,
-            'vegan': 10, 'natural': 8, 'hemp': 15, 'cork': 12, 'linen': 10,
-            'cotton': 5, 'wool': 5, 'certified': 10, 'b-corp': 12,
-            'carbon-neutral': 18, 'zero-waste': 15, 'upcycled': 12,
-            'plant-based': 12, 'cruelty-free': 10, 'ethical': 10,
-            'handmade': 8, 'local': 8, 'durable': 10, 'refillable': 12
-        }
-        
-        negative = {
-            'plastic': -15, 'synthetic': -12, 'disposable': -18,
-            'single-use': -20, 'petroleum': -15, 'chemical': -10,
-            'toxic': -18, 'non-recyclable': -15, 'polyester': -10,
-            'nylon': -8, 'acrylic': -10, 'pvc': -15, 'vinyl': -12,
-            'styrofoam': -20, 'fast-fashion': -15, 'cheap': -5,
-            'mass-produced': -8, 'imported': -3, 'bleached': -8
-        }
-        
-        found_pos = []
-        found_neg = []
-        score_adjust = 0
-        
-        for word, value in positive.items():
-            if word in text:
-                found_pos.append(word)
-                score_adjust += value
-        
-        for word, value in negative.items():
-            if word in text:
-                found_neg.append(word)
-                score_adjust += value
+        started = time.time()
+        result = self._keyword_result(KEYWORD_LEXICON.found(self._keyword_text(product_data)))
+        METRICS.observe("keyword", time.time() - started)
+        return result
+    
+    def _keyword_analysis_many(self, products):
+        """Keyword analysis for a batch of products"""
+        started = time.time()
+        results = [self._keyword_result(KEYWORD_LEXICON.found(self._keyword_text(p))) for p in products]
+        # One sample per product, at the batch's average cost
+        if results:
+            per_product = (time.time() - started) / len(results)
+            for _ in results:
+                METRICS.observe("keyword", per_product)
+        return results
+    
+    def _keyword_result(self, found):
+        """Score and explanations from the set of keywords found in a product"""
+        # Keep the lexicon order so explanations list materials consistently
+        found_pos = [word for word in KEYWORD_POSITIVE if word in found]
+        found_neg = [word for word in KEYWORD_NEGATIVE if word in found]
+        score_adjust = sum(KEYWORD_POSITIVE[w] for w in found_pos) + sum(KEYWORD_NEGATIVE[w] for w in found_neg)
         
         score = max(0, min(100, 50 + score_adjust))
         
@@ -455,26 +3014,80 @@ class SustainabilityAnalyzer:
             "recommendation": rec
         }
     
-    def analyze(self, product_data):
-        """Analyze a product - uses LLM if available, keyword fallback otherwise"""
+    def _cached_result(self, product_data, cache_key):
+        """Result cache lookup, marks hits as cached"""
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            title = product_data.get('productTitle', 'Unknown')[:40]
+            print(f"[CACHE] '{title}' -> Score: {cached['greenScore']}")
+            cached["cached"] = True
+        return cached
+    
+    def _scoring_mode(self, product_data):
+        """"likelihood" or "generate" for a request that uses the model"""
+        return 'likelihood' if ResultCache.scoring_mode(product_data) == 'likelihood' else 'generate'
+    
+    def _wants_llm(self, product_data):
+        """LLM unless the model can't infer or the request asked for keyword scoring"""
+        return (self.can_infer and self.tokenizer is not None
+                and product_data.get('mode', 'auto') != 'keyword')
+    
+    def analyze(self, product_data, on_text=None, info=None, cancel=None, trace=NULL_TRACE):
+        """Analyze a product - uses LLM if available, keyword fallback otherwise.
+
+        on_text, if given, receives decoded LLM text deltas as tokens are generated.
+        If info is a dict it is filled with generation details (tokens, timings).
+        cancel is an optional CancelToken (deadline, client disconnect), trace a Trace
+        that records the stages of this request.
+        """
+        # Same product seen recently (page reload, another user on the listing)
+        with trace.span("cache"):
+            cache_key = ResultCache.make_key(product_data)
+            cached = self._cached_result(product_data, cache_key)
+        if cached is not None:
+            return cached
+        return self._analyze_uncached(product_data, cache_key, on_text, info, cancel=cancel, trace=trace)
+    
+    def _analyze_uncached(self, product_data, cache_key, on_text=None, info=None, route=True, cancel=None,
+                          trace=NULL_TRACE):
         start_time = time.time()
         engine = "executorch-llama-3.2-1b"
         used_llm = False
-        
         result = None
+        llm_info = info if info is not None else {}
+        
+        # Pick full, shortened or keyword-only scoring from the latency budget
+        likelihood = self._scoring_mode(product_data) == 'likelihood'
+        tier, stop = "keyword", None
+        if self._wants_llm(product_data):
+            with trace.span("route"):
+                tier, stop = self.router.route(product_data, self.queue, likelihood) if route else ("llm", None)
         
         # Try real LLM inference first
-        if self.can_infer and self.model and self.tokenizer:
+        if tier != "keyword":
             try:
-                prompt = SUSTAINABILITY_PROMPT.format(
-                    title=product_data.get('productTitle', 'Unknown')[:30],
-                    materials=product_data.get('materials', 'Not specified')[:30]
-                )
+                prompt = ScorePrompt(product_data) if likelihood else ProductPrompt(product_data)
                 
-                llm_output = self._run_llm_inference(prompt)
+                # Model work runs on the inference worker, this thread just waits
+                with trace.span("inference", tier=tier, likelihood=likelihood):
+                    llm_output = self._run_llm_inference(prompt, on_text, llm_info, stop, cancel, trace)
                 
-                if llm_output and len(llm_output.strip()) > 5:
+                if likelihood:
+                    result = self._likelihood_result(product_data, llm_info.get("likelihood"))
+                    if result is not None:
+                        used_llm = True
+                        engine = "executorch-llama-3.2-1b-likelihood"
+                    else:
+                        # No usable score distribution: generate the answer instead
+                        with trace.span("inference", tier=tier, likelihood=False):
+                            llm_output = self._run_llm_inference(ProductPrompt(product_data), on_text, llm_info,
+                                                                 stop, cancel, trace)
+                if result is None and llm_output and len(llm_output.strip()) > 5:
+                    started = time.time()
                     parsed = self._parse_llm_response(llm_output, product_data)
+                    ended = time.time()
+                    METRICS.observe("parse", ended - started)
+                    trace.add("parse", started, ended)
                     if parsed and 'greenScore' in parsed:
                         # Blend LLM score with keyword score for better results
                         kw_result = self._keyword_analysis(product_data)
@@ -493,16 +3106,70 @@ class SustainabilityAnalyzer:
                         used_llm = True
                         engine = "executorch-llama-3.2-1b-inference"
                         
+            except QueueFullError:
+                raise
+            except RequestCancelledError as e:
+                # Nobody is waiting for a cancelled request; an expired one still gets a quick answer
+                if e.reason == "cancelled":
+                    raise
+                print("[INFO] Deadline passed while queued, using keyword scoring")
             except Exception as e:
+                METRICS.inc("greenlane_errors_total", kind="llm_fallback")
                 print(f"[WARN] LLM inference failed, using keyword fallback: {e}")
         
         # Fallback to keyword analysis
         if result is None:
-            result = self._keyword_analysis(product_data)
+            with trace.span("keyword"):
+                result = self._keyword_analysis(product_data)
             engine = "executorch-llama-3.2-1b-hybrid"
+            tier = "keyword"
         
+        # Routed away from the full generation: compute it later for the next lookup
+        upgrade = False
+        if route:
+            self.router.count(tier)
+            upgrade = (tier in ("keyword", "llm-short") and self._wants_llm(product_data)
+                       and self._schedule_upgrade(product_data, cache_key))
+        return self._finish_result(product_data, cache_key, result, engine, used_llm, llm_info, start_time,
+                                   tier, upgrade)
+    
+    def _schedule_upgrade(self, product_data, cache_key):
+        """Queue a background LLM analysis that replaces a keyword answer in the result cache"""
+        if cache_key is None:
+            return False
+        with self.upgrade_lock:
+            if cache_key in self.upgrades_pending:
+                return True
+            if len(self.upgrades_pending) >= UPGRADE_MAX_PENDING:
+                self.router.upgrades_dropped += 1
+                return False
+            self.upgrades_pending.add(cache_key)
+            self.router.upgrades_queued += 1
+        self.upgrade_executor.submit(self._upgrade, dict(product_data), cache_key)
+        return True
+    
+    def _upgrade(self, product_data, cache_key):
+        try:
+            # Only spare capacity: live requests never wait behind an upgrade
+            while self.queue.expected_wait_ms() > 0:
+                time.sleep(0.1)
+            result = self._analyze_uncached(product_data, cache_key, route=False)
+            if result.get("usedLLM"):
+                self.router.upgrades_done += 1
+        except Exception as e:
+            print(f"[WARN] Background upgrade failed: {e}")
+        finally:
+            with self.upgrade_lock:
+                self.upgrades_pending.discard(cache_key)
+    
+    def _finish_result(self, product_data, cache_key, result, engine, used_llm, llm_info, start_time,
+                       tier=None, upgrade_pending=False):
+        """Add response metadata, record timing and store the result in the cache"""
         inference_time = (time.time() - start_time) * 1000
         self.inference_times.append(inference_time)
+        self.total_inferences += 1
+        METRICS.observe("analyze", inference_time / 1000)
+        METRICS.inc("greenlane_analyses_total", engine="llm" if used_llm else "keyword")
         
         title = product_data.get('productTitle', 'Unknown')[:40]
         mode = "LLM" if used_llm else "keyword"
@@ -514,93 +3181,693 @@ class SustainabilityAnalyzer:
             "modelLoaded": self.model_loaded,
             "tokenizerLoaded": self.tokenizer is not None,
             "usedLLM": used_llm,
-            "inferenceMs": round(inference_time, 1)
+            "inferenceMs": round(inference_time, 1),
+            "stopReason": llm_info.get("stopReason") if used_llm else None,
+            "tier": tier,
+            "upgradePending": upgrade_pending,
+            "cached": False
         })
         
+        # Don't pin a keyword fallback in the cache when the LLM should have answered,
+        # nor a shortened (llm-short) generation or one cut short by a deadline, time
+        # budget or disconnect: the full answer is cached once it has run
+        complete = tier != "llm-short" and llm_info.get("stopReason") not in self.TRUNCATED_STOPS
+        if (used_llm and complete) or (self.ready and not self.can_infer):
+            self.result_cache.put(cache_key, result)
+        
         return result
     
+    def analyze_many(self, products, cancel=None, trace=NULL_TRACE):
+        """Analyze a batch, yielding (index, result) as results become ready.
+
+        Identical products are analyzed once. Cached and keyword-only items are
+        answered first, then LLM items run concurrently so the inference worker
+        can micro-batch them.
+        """
+        groups = OrderedDict()  # cache key -> indices of identical products
+        for i, product in enumerate(products):
+            if not isinstance(product, dict) or not product.get('productTitle'):
+                yield i, {"error": "productTitle is required"}
+                continue
+            groups.setdefault(ResultCache.make_key(product), []).append(i)
+        
+        def fan_out(indices, result):
+            for n, i in enumerate(indices):
+                yield i, result if n == 0 else dict(result)
+        
+        keyword_groups = []
+        llm_groups = []
+        for key, indices in groups.items():
+            product = products[indices[0]]
+            with trace.span("cache"):
+                cached = self._cached_result(product, key)
+            if cached is not None:
+                yield from fan_out(indices, cached)
+            elif self._wants_llm(product):
+                llm_groups.append((key, indices))
+            else:
+                keyword_groups.append((key, indices))
+        
+        # Keyword-only items in one lexicon call, no queueing
+        if keyword_groups:
+            start_time = time.time()
+            batch = [products[indices[0]] for _, indices in keyword_groups]
+            with trace.span("keyword", items=len(batch)):
+                keyword_results = self._keyword_analysis_many(batch)
+            for (key, indices), result in zip(keyword_groups, keyword_results):
+                self.router.count("keyword")
+                result = self._finish_result(products[indices[0]], key, result,
+                                             "executorch-llama-3.2-1b-hybrid", False, {}, start_time, "keyword")
+                yield from fan_out(indices, result)
+        
+        if not llm_groups:
+            return
+        
+        # One more caller than sessions keeps the next item queued while the batch runs
+        workers = min(len(llm_groups), self.queue.parallelism + 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self._analyze_uncached, products[indices[0]], key, cancel=cancel, trace=trace): indices
+                for key, indices in llm_groups
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except QueueFullError as e:
+                    result = {"error": str(e), "retryAfter": e.retry_after}
+                except Exception as e:
+                    result = {"error": str(e)}
+                yield from fan_out(futures[future], result)
+    
+    def _prefix_cache_stats(self):
+        """Prefix cache counters summed over the session pool (or the worker processes)"""
+        if isinstance(self.queue, ProcessPool):
+            stats = self.queue.prefix_cache_stats()
+        else:
+            stats = self.session.get_prefix_cache_stats()
+        for session in self.sessions[1:]:
+            extra = session.get_prefix_cache_stats()
+            for key in ("hits", "misses", "reusedTokens"):
+                stats[key] += extra[key]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRate"] = round(stats["hits"] / lookups, 3) if lookups else 0
+        return stats
+    
+    def _workers_speculate(self):
+        return isinstance(self.queue, ProcessPool) and any(w.info.get("speculative") for w in self.queue.workers)
+    
+    def _speculative_stats(self):
+        proposed = METRICS.value("greenlane_draft_proposed_tokens_total")
+        accepted = METRICS.value("greenlane_draft_accepted_tokens_total")
+        forwards = METRICS.value("greenlane_decode_forwards_total")
+        return {
+            "mode": SPECULATIVE if self.draft is not None or self._workers_speculate() else "off",
+            "draftTokens": SPECULATIVE_TOKENS,
+            "proposed": proposed,
+            "accepted": accepted,
+            "acceptanceRate": round(accepted / proposed, 3) if proposed else 0,
+            "tokensPerForward": round((forwards + accepted) / forwards, 2) if forwards else 0
+        }
+    
+    def metrics_text(self):
+        """/metrics body: stage histograms and counters plus gauges read from live state"""
+        queue_stats = self.queue.get_stats() if self.queue is not None else {}
+        reloads = sum(max(0, session.loads - 1) for session in self.sessions) + queue_stats.get("restarts", 0)
+        cache = self.result_cache.get_stats()
+        return METRICS.render([
+            ("greenlane_model_ready", "gauge", "1 once the model can run inference", int(self.can_infer)),
+            ("greenlane_model_reloads_total", "counter", "Program reloads after startup (reload mode, worker restarts)", reloads),
+            ("greenlane_result_cache_hits_total", "counter", "Result cache hits", cache["hits"]),
+            ("greenlane_result_cache_misses_total", "counter", "Result cache misses", cache["misses"]),
+            ("greenlane_queue_depth", "gauge", "Requests waiting for the model", queue_stats.get("depth", 0)),
+            ("greenlane_queue_in_flight", "gauge", "Generations running", queue_stats.get("inFlight", 0)),
+            ("greenlane_queue_rejected_total", "counter", "Requests rejected with 503 (queue full)", queue_stats.get("rejected", 0))
+        ])
+    
+    def variant_stats(self):
+        """Model variants with their benchmark numbers, live decode speed for the active one"""
+        estimate = self.router.estimate(self.queue) if self.queue is not None else None
+        token_ms = estimate["tokenMs"] if estimate else None
+        stats = self.registry.get_stats(round(1000 / token_ms, 1) if token_ms else None)
+        stats["swaps"] = self.swaps
+        stats["swapInProgress"] = self.swap_lock.locked()
+        return stats
+
     def get_status(self):
-        avg_time = sum(self.inference_times[-10:]) / len(self.inference_times[-10:]) if self.inference_times else 0
+        recent = list(self.inference_times)[-10:]
+        avg_time = sum(recent) / len(recent) if recent else 0
         
         return {
             "model": "Llama-3.2-1B-ET",
-            "modelPath": str(MODEL_PATH),
+            "modelPath": str(self.model_path),
+            "modelVariant": self.registry.active,
             "modelSizeGB": round(self.model_size_gb, 2),
             "modelLoaded": self.model_loaded,
             "canInfer": self.can_infer,
             "modelLoadError": model_load_error,
             "tokenizerLoaded": self.tokenizer is not None,
             "tokenizerBackend": self.tokenizer.backend if self.tokenizer else None,
+            "tokenizer": self.tokenizer.get_stats() if self.tokenizer else None,
             "executorchAvailable": executorch_available,
             "docker": IS_DOCKER,
+            "ready": self.ready,
+            "startup": self.startup,
+            "weights": self.weights.get_stats(),
             "avgInferenceMs": round(avg_time, 1),
-            "totalInferences": len(self.inference_times)
+            "totalInferences": self.total_inferences,
+            "speculative": self._speculative_stats(),
+            "variants": self.variant_stats(),
+            "tracing": TRACER.get_stats(),
+            "router": self.router.get_stats(self.queue),
+            "cancellation": {
+                "cancelled": METRICS.value("greenlane_cancelled_total", reason="cancelled"),
+                "expired": METRICS.value("greenlane_cancelled_total", reason="expired"),
+                "deadline": METRICS.value("greenlane_cancelled_total", reason="deadline")
+            },
+            "stages": METRICS.stage_stats(),
+            "session": self.session.get_stats(),
+            "prefixCache": self._prefix_cache_stats(),
+            "resultCache": self.result_cache.get_stats(),
+            "queue": self.queue.get_stats() if self.queue is not None else None
         }
 
 
 class RequestHandler(BaseHTTPRequestHandler):
     analyzer = None
+    # Keep-alive: clients reuse one connection for many products
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
     
     def log_message(self, format, *args):
         pass
     
-    def send_json(self, data, status=200):
+    def query_flag(self, name):
+        """True for ?name, ?name=1 or ?name=true"""
+        values = parse_qs(urlparse(self.path).query, keep_blank_values=True).get(name)
+        return bool(values) and values[0] not in ('0', 'false')
+    
+    def shape_result(self, result):
+        """Analysis result as sent: only ?fields=a,b when given, debug fields only with ?debug=1"""
+        fields = parse_qs(urlparse(self.path).query).get('fields', [''])[0]
+        if fields:
+            keep = {name.strip() for name in fields.split(',')} | {"index", "error", "retryAfter"}
+            return {key: value for key, value in result.items() if key in keep}
+        if self.query_flag('debug'):
+            return result
+        return {key: value for key, value in result.items() if key not in DEBUG_FIELDS}
+    
+    def send_json(self, data, status=200, headers=None):
+        started = time.time()
+        body = dump_json(data, pretty=self.query_flag('pretty'))
+        METRICS.observe("serialize", time.time() - started)
         self.send_response(status)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if status >= 400:
+            kind = "overloaded" if status == 503 else "internal" if status >= 500 else "bad_request"
+            METRICS.inc("greenlane_errors_total", kind=kind)
+        self.wfile.write(body)
+    
+    def send_text(self, text, content_type='text/plain; version=0.0.4'):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data, indent=2).encode())
+        self.wfile.write(body)
     
     def do_OPTIONS(self):
         self.send_json({})
     
     def do_GET(self):
-        if self.path == '/health':
+        path = urlparse(self.path).path
+        if path == '/health':
+            # Liveness answers while the model warms up, ?ready=1 is the readiness probe
+            ready = self.analyzer.ready
+            wants_ready = parse_qs(urlparse(self.path).query).get('ready', ['0'])[0] not in ('', '0', 'false')
             self.send_json({
-                "status": "ok",
+                "status": "ok" if ready or not wants_ready else "starting",
                 "engine": "executorch",
                 "model": "llama-3.2-1b",
+                "ready": ready,
+                "phase": self.analyzer.startup["phase"],
                 "canInfer": CAN_INFER,
                 "docker": IS_DOCKER
-            })
-        elif self.path == '/status':
+            }, 200 if ready or not wants_ready else 503)
+        elif path == '/status':
             self.send_json(self.analyzer.get_status())
+        elif path == '/metrics':
+            self.send_text(self.analyzer.metrics_text())
+        elif path == '/admin/models':
+            if self.admin_allowed():
+                self.send_json(self.analyzer.variant_stats())
+        elif path == '/debug/traces':
+            if self.admin_allowed():
+                self.send_traces()
         else:
             self.send_json({"error": "Not found"}, 404)
     
+    def admin_allowed(self):
+        """ADMIN_TOKEN in X-Admin-Token when configured, loopback clients otherwise; answers 403 if not"""
+        if ADMIN_TOKEN:
+            allowed = hmac.compare_digest(self.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+        else:
+            allowed = self.client_address[0] in ('127.0.0.1', '::1')
+        if not allowed:
+            self.send_json({"error": "Forbidden"}, 403)
+        return allowed
+    
+    def read_json(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length).decode()
+        return json.loads(body)
+    
+    def client_gone(self):
+        """True once the client closed its end of the connection"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            # Readable with nothing to peek at means EOF; pipelined bytes keep it alive
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+    
+    def cancel_token(self, data=None):
+        """CancelToken for this request: deadlineMs field, X-Deadline-Ms header or REQUEST_DEADLINE_MS"""
+        deadline = data.get('deadlineMs') if isinstance(data, dict) else None
+        if deadline is None:
+            deadline = self.headers.get('X-Deadline-Ms', REQUEST_DEADLINE_MS)
+        try:
+            deadline = max(0.0, float(deadline))
+        except (TypeError, ValueError):
+            deadline = REQUEST_DEADLINE_MS
+        return CancelToken(deadline, probe=self.client_gone)
+    
+    def start_trace(self, name):
+        """Trace for this request: "X-Trace: 1" forces one, TRACE_SAMPLE_RATE samples the rest"""
+        return TRACER.start(name, forced=self.headers.get('X-Trace', '') not in ('', '0', 'false'))
+    
+    @staticmethod
+    def trace_headers(trace, headers=None):
+        """Response headers with X-Trace-Id added for a traced request"""
+        if not trace.enabled:
+            return headers
+        return {**(headers or {}), 'X-Trace-Id': trace.id}
+    
+    def send_traces(self):
+        """Buffered traces as Chrome trace-event JSON (?id= for one, ?list=1 for summaries)"""
+        query = parse_qs(urlparse(self.path).query)
+        traces = TRACER.find(query.get('id', [None])[0])
+        if self.query_flag('list'):
+            self.send_json({"traces": [t.summary() for t in traces], **TRACER.get_stats()})
+        elif not traces and 'id' in query:
+            self.send_json({"error": "Trace not found (evicted or never recorded)"}, 404)
+        else:
+            self.send_json(TRACER.chrome_trace(traces))
+    
+    def apply_latency_budget(self, product):
+        """X-Latency-Budget-Ms header as the budget for a product that sends none"""
+        budget = self.headers.get('X-Latency-Budget-Ms')
+        if budget is not None and isinstance(product, dict):
+            product.setdefault('latencyBudgetMs', budget)
+    
+    def send_event(self, event, data):
+        """Write one server-sent event, returns False once the client has gone away"""
+        try:
+            started = time.time()
+            payload = dump_json(data)
+            METRICS.observe("serialize", time.time() - started)
+            self.wfile.write(b"event: " + event.encode() + b"\ndata: " + payload + b"\n\n")
+            self.wfile.flush()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+    
+    def stream_analyze(self, data, trace=NULL_TRACE):
+        """Server-sent events: keyword result, LLM text deltas, then the final result"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # No Content-Length, the end of the stream is the end of the connection
+        self.send_header('Connection', 'close')
+        for name, value in (self.trace_headers(trace) or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        
+        with trace.span("keyword"):
+            keyword = self.analyzer._keyword_analysis(data)
+        if not self.send_event("keyword", keyword):
+            return
+        
+        # analyze() runs on a helper thread, deltas arrive here from the inference worker
+        events = queue.Queue()
+        cancel = self.cancel_token(data)
+        
+        def run():
+            try:
+                result = self.analyzer.analyze(data, on_text=lambda d: events.put(("token", {"text": d})),
+                                               cancel=cancel, trace=trace)
+                events.put(("result", self.shape_result(result)))
+            except QueueFullError as e:
+                events.put(("error", {"error": str(e), "retryAfter": e.retry_after}))
+            except Exception as e:
+                events.put(("error", {"error": str(e)}))
+        
+        threading.Thread(target=run, daemon=True).start()
+        
+        while True:
+            event, payload = events.get()
+            if not self.send_event(event, payload) or event != "token":
+                return
+    
+    def batch_analyze(self, products, query, cancel, trace=NULL_TRACE):
+        """Results in request order, as JSON or (stream=ndjson) one line per finished item"""
+        if query.get('stream', [''])[0] == 'ndjson' or 'application/x-ndjson' in self.headers.get('Accept', ''):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Connection', 'close')
+            for name, value in (self.trace_headers(trace) or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            for index, result in self.analyzer.analyze_many(products, cancel, trace):
+                try:
+                    self.wfile.write(dump_json(self.shape_result({"index": index, **result})) + b"\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+            return
+        
+        results = [None] * len(products)
+        for index, result in self.analyzer.analyze_many(products, cancel, trace):
+            results[index] = self.shape_result(result)
+        with trace.span("serialize"):
+            self.send_json({"results": results, "count": len(results)}, headers=self.trace_headers(trace))
+    
     def do_POST(self):
-        if self.path == '/analyze':
+        url = urlparse(self.path)
+        trace = self.start_trace(url.path) if url.path.startswith('/analyze') else NULL_TRACE
+        try:
+            self.handle_post(url, trace)
+        finally:
+            TRACER.finish(trace, path=url.path)
+    
+    def handle_post(self, url, trace):
+        if url.path == '/analyze/batch':
+            try:
+                with trace.span("read"):
+                    data = self.read_json()
+            except json.JSONDecodeError:
+                self.send_json({"error": "Invalid JSON"}, 400)
+                return
+            products = data.get('products') if isinstance(data, dict) else data
+            if not isinstance(products, list):
+                self.send_json({"error": "Expected a JSON array or {\"products\": [...]}"}, 400)
+                return
+            if len(products) > BATCH_MAX_ITEMS:
+                self.send_json({"error": f"At most {BATCH_MAX_ITEMS} products per batch"}, 413)
+                return
+            for product in products:
+                self.apply_latency_budget(product)
+            if trace.enabled:
+                trace.args["items"] = len(products)
+            self.batch_analyze(products, parse_qs(url.query), self.cancel_token(data), trace)
+        elif url.path == '/analyze/stream':
+            try:
+                with trace.span("read"):
+                    data = self.read_json()
+            except json.JSONDecodeError:
+                self.send_json({"error": "Invalid JSON"}, 400)
+                return
+            if not isinstance(data, dict):
+                self.send_json({"error": "Expected a JSON object"}, 400)
+                return
+            if not data.get('productTitle'):
+                self.send_json({"error": "productTitle is required"}, 400)
+                return
+            self.apply_latency_budget(data)
+            self.stream_analyze(data, trace)
+        elif url.path == '/analyze':
             try:
-                content_length = int(self.headers.get('Content-Length', 0))
-                body = self.rfile.read(content_length).decode()
-                data = json.loads(body)
+                with trace.span("read"):
+                    data = self.read_json()
                 
                 if not data.get('productTitle'):
                     self.send_json({"error": "productTitle is required"}, 400)
                     return
                 
-                result = self.analyzer.analyze(data)
-                self.send_json(result)
+                self.apply_latency_budget(data)
+                result = self.analyzer.analyze(data, cancel=self.cancel_token(data), trace=trace)
+                if trace.enabled:
+                    trace.args.update({key: result.get(key) for key in ("tier", "usedLLM", "cached", "stopReason")})
+                with trace.span("serialize"):
+                    self.send_json(self.shape_result(result), headers=self.trace_headers(trace))
                 
             except json.JSONDecodeError:
                 self.send_json({"error": "Invalid JSON"}, 400)
+            except RequestCancelledError:
+                # The client hung up, there is no one to answer
+                self.close_connection = True
+            except QueueFullError as e:
+                self.send_json({"error": str(e), "retryAfter": e.retry_after}, 503,
+                               headers={'Retry-After': str(e.retry_after)})
+            except Exception as e:
+                self.send_json({"error": str(e)}, 500)
+        elif url.path == '/admin/model':
+            try:
+                data = self.read_json()
+            except json.JSONDecodeError:
+                self.send_json({"error": "Invalid JSON"}, 400)
+                return
+            if not self.admin_allowed():
+                return
+            name = data.get('variant') if isinstance(data, dict) else None
+            if name not in self.analyzer.registry.variants:
+                self.send_json({"error": f"Unknown variant {name!r}",
+                                "variants": list(self.analyzer.registry.variants)}, 404)
+                return
+            try:
+                self.send_json(self.analyzer.swap_model(name))
+            except RuntimeError as e:
+                busy = self.analyzer.swap_lock.locked() or not self.analyzer.ready
+                self.send_json({"error": str(e)}, 409 if busy else 500)
             except Exception as e:
                 self.send_json({"error": str(e)}, 500)
         else:
-            self.send_json({"error": "Not found"}, 404)
+            # The body wasn't read, so the connection can't carry another request
+            self.send_json({"error": "Not found"}, 404, headers={'Connection': 'close'})
+
+
+# Canned completion the stub program replays in benchmarks
+STUB_COMPLETION = (" 7 out of 10. It is made with bamboo and is biodegradable. "
+                   "The packaging uses some plastic. Overall a good choice for green buyers.")
+
+
+def bench_decode(generations=50):
+    """Micro-benchmark: per-step decode overhead outside the model call, using StubProgram"""
+    load_runtime()
+    tok = LlamaTokenizer(TOKENIZER_PATH)
+    stub = StubProgram(tok.vocab_size, tok.encode(STUB_COMPLETION)[1:])
+    session = ModelSession(MODEL_PATH)
+    session.program = stub
+    session.prefill_mode = "batched"
+    sampler = GreedySampler(tok.eos_ids)
+    stop = StopCriteria()
+    prompt = ProductPrompt({"productTitle": "Bamboo Toothbrush", "materials": "bamboo"})
+
+    steps = 0
+    step_time = 0.0
+    model_time = 0.0
+    for i in range(generations):
+        generation = Generation(tok, prompt, stop=stop, sampler=sampler)
+        generation.start(session)
+        stub.busy = 0.0
+        start = time.perf_counter()
+        while not generation.done:
+            generation.step()
+            steps += 1
+        step_time += time.perf_counter() - start
+        model_time += stub.busy
+
+    overhead_us = (step_time - model_time) / steps * 1e6 if steps else 0
+    print(f"[BENCH] {steps} decode steps over {generations} generations")
+    print(f"[BENCH] Per-step total: {step_time / steps * 1e6:.1f} us, in stub forward: {model_time / steps * 1e6:.1f} us")
+    print(f"[BENCH] Per-step overhead outside the model call: {overhead_us:.1f} us")
+    return overhead_us
+
+
+BENCH_CORPUS_PATH = Path(__file__).parent / "bench_products.jsonl"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where resource is unavailable)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def stub_analyzer():
+    """Analyzer whose sessions run StubProgram, for benchmarks without the model"""
+    analyzer = SustainabilityAnalyzer()
+    load_runtime()
+    analyzer.tokenizer = LlamaTokenizer(TOKENIZER_PATH)
+    analyzer.sampler = GreedySampler(analyzer.tokenizer.eos_ids)
+    script = analyzer.tokenizer.encode(STUB_COMPLETION)[1:]
+    prefix_tokens = prompt_prefix_tokens(analyzer.tokenizer)
+    analyzer.sessions = []
+    for i in range(max(1, MODEL_POOL_SIZE)):
+        session = analyzer.session if i == 0 else ModelSession(MODEL_PATH)
+        session.program = StubProgram(analyzer.tokenizer.vocab_size, script, full_logits=SPECULATIVE != "off")
+        session.prefill_mode = "batched"
+        session.full_logits = session.program.full_logits
+        session.warm_prefix(prefix_tokens)
+        analyzer.sessions.append(session)
+    analyzer.queue = InferenceQueue(analyzer.sessions)
+    analyzer.draft = NgramDraft() if SPECULATIVE == "ngram" else None
+    analyzer.model_loaded = analyzer.can_infer = analyzer.ready = True
+    return analyzer
+
+
+def bench(corpus_path=BENCH_CORPUS_PATH, modes=("llm", "likelihood", "keyword"), concurrency=1, rounds=1, stub=False):
+    """Replay a JSONL corpus of product payloads through analyze(), returns a summary per mode.
+
+    The result cache is disabled so every request reaches the model (or the keyword scorer).
+    """
+    with open(corpus_path) as f:
+        products = [json.loads(line) for line in f if line.strip()]
+    analyzer = stub_analyzer() if stub else SustainabilityAnalyzer()
+    if not stub:
+        analyzer.warm_up()
+    analyzer.result_cache = ResultCache(max_entries=0, path="")
+    print(f"[BENCH] {len(products)} products x {rounds} round(s), concurrency {concurrency}, "
+          f"{'stub model' if stub else 'LLM' if analyzer.can_infer else 'no model (keyword only)'}")
+
+    summary = {"corpus": str(corpus_path), "products": len(products), "rounds": rounds,
+               "concurrency": concurrency, "stub": stub, "modes": {}}
+    for mode in modes:
+        payloads = [dict(p, mode=mode) for p in products] * rounds
+
+        def run(product):
+            info = {}
+            start = time.perf_counter()
+            try:
+                result = analyzer.analyze(product, info=info)
+            except QueueFullError:
+                # The server answers these with 503, they count as rejected rather than latency
+                return None
+            return (time.perf_counter() - start) * 1000, result.get("usedLLM", False), info
+
+        # Warm-up request, not measured
+        run(payloads[0])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            answered = list(executor.map(run, payloads))
+        wall = time.perf_counter() - start
+        samples = [sample for sample in answered if sample is not None]
+
+        latencies = [ms for ms, _, _ in samples]
+        llm = [info for _, used_llm, info in samples if used_llm and "ttftMs" in info]
+        prompt_tokens = sum(i["promptTokens"] for i in llm)
+        generated_tokens = sum(i["generatedTokens"] for i in llm)
+        prefill_s = sum(i["prefillMs"] for i in llm) / 1000
+        decode_s = sum(i["decodeMs"] for i in llm) / 1000
+        proposed = sum(i.get("draftProposed", 0) for i in llm)
+        accepted = sum(i.get("draftAccepted", 0) for i in llm)
+        forwards = sum(i.get("forwards", 0) for i in llm)
+        stats = {
+            "requests": len(samples),
+            "rejected": len(answered) - len(samples),
+            "llmRequests": len(llm),
+            "throughputRps": round(len(samples) / wall, 2) if wall > 0 else 0,
+            "latencyP50Ms": round(percentile(latencies, 50), 1),
+            "latencyP95Ms": round(percentile(latencies, 95), 1),
+            "latencyP99Ms": round(percentile(latencies, 99), 1),
+            "ttftP50Ms": round(percentile([i["ttftMs"] for i in llm], 50), 1),
+            "ttftP95Ms": round(percentile([i["ttftMs"] for i in llm], 95), 1),
+            "prefillTokPerSec": round(prompt_tokens / prefill_s, 1) if prefill_s > 0 else 0,
+            "decodeTokPerSec": round(generated_tokens / decode_s, 1) if decode_s > 0 else 0,
+            "draftAcceptance": round(accepted / proposed, 3) if proposed else None,
+            "tokensPerForward": round((forwards + accepted) / forwards, 2) if forwards else None,
+            "peakRssMb": peak_rss_mb()
+        }
+        summary["modes"][mode] = stats
+        print(f"[BENCH] {mode}: {stats['requests']} requests ({stats['llmRequests']} LLM), "
+              f"{stats['throughputRps']} req/s, latency p50/p95/p99 "
+              f"{stats['latencyP50Ms']}/{stats['latencyP95Ms']}/{stats['latencyP99Ms']} ms")
+        if stats["rejected"]:
+            print(f"[BENCH] {mode}: {stats['rejected']} requests rejected by the full queue "
+                  f"(QUEUE_MAX {QUEUE_MAX}, concurrency {concurrency})")
+        if llm:
+            print(f"[BENCH] {mode}: TTFT p50/p95 {stats['ttftP50Ms']}/{stats['ttftP95Ms']} ms, "
+                  f"prefill {stats['prefillTokPerSec']} tok/s, decode {stats['decodeTokPerSec']} tok/s")
+        if proposed:
+            print(f"[BENCH] {mode}: draft acceptance {stats['draftAcceptance']:.0%}, "
+                  f"{stats['tokensPerForward']} tokens per decode forward")
+        print(f"[BENCH] {mode}: peak RSS {stats['peakRssMb']} MB")
+    return summary
+
+
+def print_startup_status(analyzer):
+    status = analyzer.get_status()
+    print(f"\n[STATUS] Model: {status['model']} (variant: {status['modelVariant'] or 'none'})")
+    print(f"[STATUS] Size: {status['modelSizeGB']} GB")
+    print(f"[STATUS] ExecuTorch: {'Yes' if status['executorchAvailable'] else 'No'}")
+    print(f"[STATUS] Model Loaded: {'Yes' if status['modelLoaded'] else 'No'}")
+    print(f"[STATUS] Can Infer: {'Yes - FULL LLM!' if status['canInfer'] else 'No (keyword fallback)'}")
+    print(f"[STATUS] Tokenizer: {status['tokenizerBackend'] or 'None'}")
+    print(f"[STATUS] Docker: {'Yes' if status['docker'] else 'No'}")
+    if status['modelLoadError']:
+        print(f"[STATUS] Note: {status['modelLoadError']}")
+    print()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="GreenLane local LLM server")
+    parser.add_argument("--bench-decode", action="store_true",
+                        help="measure per-step decode overhead with a stub model and exit")
+    parser.add_argument("--bench", action="store_true",
+                        help="replay a product corpus through analyze, print latency/throughput and exit")
+    parser.add_argument("--bench-corpus", default=str(BENCH_CORPUS_PATH),
+                        help="JSONL file of product payloads (default: bench_products.jsonl)")
+    parser.add_argument("--bench-modes", default="llm,likelihood,keyword",
+                        help="comma-separated analysis modes to benchmark")
+    parser.add_argument("--bench-concurrency", type=int, default=1,
+                        help="concurrent requests during the benchmark")
+    parser.add_argument("--bench-rounds", type=int, default=1,
+                        help="times the corpus is replayed per mode")
+    parser.add_argument("--bench-json", help="also write the benchmark summary to this file")
+    parser.add_argument("--stub", action="store_true",
+                        help="benchmark with the deterministic stub model instead of the .pte")
+    args = parser.parse_args()
+    if args.bench_decode:
+        bench_decode()
+        return
+    if args.bench:
+        summary = bench(args.bench_corpus, [m for m in args.bench_modes.split(",") if m],
+                        args.bench_concurrency, args.bench_rounds, args.stub)
+        if args.bench_json:
+            with open(args.bench_json, "w") as f:
+                json.dump(summary, f, indent=2)
+        return
+    
     print()
     print("=" * 60)
     print("  GreenLane Local LLM - Meta ExecuTorch + Llama 3.2")
     if IS_DOCKER:
         print("  Running in Docker Container")
     print("=" * 60)
-    print(f"  Model: Llama-3.2-1B-ET ({MODEL_PATH})")
-    print(f"  Runtime: ExecuTorch {'+ XNNPACK' if IS_DOCKER else 'Portable'}")
+    print(f"  Model: Llama-3.2-1B-ET ({MODEL_DIR})")
+    print(f"  Variant: {MODEL_VARIANT} (picked at startup, see /status variants)")
     print("  100% On-Device | No Cloud | Complete Privacy")
     print("=" * 60)
     print()
@@ -608,21 +3875,21 @@ def main():
     analyzer = SustainabilityAnalyzer()
     RequestHandler.analyzer = analyzer
     
-    status = analyzer.get_status()
-    print(f"\n[STATUS] Model: {status['model']}")
-    print(f"[STATUS] Size: {status['modelSizeGB']} GB")
-    print(f"[STATUS] ExecuTorch: {'Yes' if status['executorchAvailable'] else 'No'}")
-    print(f"[STATUS] Model Loaded: {'Yes' if status['modelLoaded'] else 'No'}")
-    print(f"[STATUS] Can Infer: {'Yes - FULL LLM!' if status['canInfer'] else 'No (keyword fallback)'}")
-    print(f"[STATUS] Tokenizer: {status['tokenizerBackend'] or 'None'}")
-    print(f"[STATUS] Docker: {'Yes' if status['docker'] else 'No'}")
-    if status['modelLoadError']:
-        print(f"[STATUS] Note: {status['modelLoadError']}")
-    print()
+    if STARTUP_WARMUP == "blocking":
+        analyzer.warm_up()
+        print_startup_status(analyzer)
+    else:
+        def warm_up():
+            analyzer.warm_up()
+            print_startup_status(analyzer)
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
     
-    server = HTTPServer(('0.0.0.0', PORT), RequestHandler)
+    # One thread per connection, so /health and /status never wait behind inference
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), RequestHandler)
+    server.daemon_threads = True
+    analyzer.startup["listeningAfterMs"] = round((time.time() - PROCESS_START) * 1000, 1)
     print(f"[SERVER] Listening on http://0.0.0.0:{PORT}")
-    print(f"[SERVER] Endpoints: GET /health, /status | POST /analyze")
+    print(f"[SERVER] Endpoints: GET /health, /status, /metrics | POST /analyze, /analyze/stream, /analyze/batch")
     print()
     print("Meta ExecuTorch Sponsor Track - SFHacks 2026")
     print("Press Ctrl+C to stop")